@@ -0,0 +1,76 @@
+"""Show query plans and latencies for the hot Fact lookups, to compare the
+table with and without the composite indexes added in migration 0004.
+
+Run against a database with realistic data, once at each migration:
+
+    DJANGO_SETTINGS_MODULE=mysite.settings python benchmarks/fact_indexes.py <survey_id>
+    ./manage.py migrate survey 0003
+    DJANGO_SETTINGS_MODULE=mysite.settings python benchmarks/fact_indexes.py <survey_id>
+    ./manage.py migrate survey
+
+fact_indexes_results.txt holds the same comparison on synthetic data from
+fact_indexes_sqlite.py, which needs only the standard library.
+"""
+import sys
+import time
+
+from django.db import connection
+
+from survey.models import Survey, Fact
+
+REPEATS = 50
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ANALYZE',
+    'sqlite': 'EXPLAIN QUERY PLAN',
+}
+
+
+def explain(queryset):
+    sql, params = queryset.query.get_compiler(connection=connection).as_sql()
+    cursor = connection.cursor()
+    cursor.execute('%s %s' % (EXPLAIN.get(connection.vendor, 'EXPLAIN'), sql),
+            params)
+    return '\n'.join(' '.join(str(col) for col in row)
+            for row in cursor.fetchall())
+
+
+def time_query(queryset):
+    start = time.time()
+    for i in range(REPEATS):
+        list(queryset.all())
+    return (time.time() - start) * 1000 / REPEATS
+
+
+def access_paths(survey):
+    sample = Fact.objects.filter(survey=survey).order_by('-id')[0]
+    numeric = Fact.objects.filter(survey=survey, numeric_data__isnull=False)\
+            .order_by('-id')[:1]
+    subject_facts = Fact.objects.filter(survey=survey,
+            content_type=sample.content_type, object_id=sample.object_id)
+
+    paths = [
+        ('existing_facts / _do_export / has_required_data', subject_facts),
+        ('create_or_update', subject_facts.filter(
+            desired_fact=sample.desired_fact)),
+        ('get_subjects by value', Fact.objects.filter(survey=survey,
+            desired_fact=sample.desired_fact, data=sample.data)),
+    ]
+    for fact in numeric:
+        paths.append(('get_subjects by range', Fact.objects.filter(
+            survey=survey, desired_fact=fact.desired_fact,
+            numeric_data__gt=fact.numeric_data)))
+    return paths
+
+
+def main(survey_id):
+    survey = Survey.objects.get(pk=survey_id)
+    sys.stdout.write('%d facts in survey %s\n\n' %
+            (Fact.objects.filter(survey=survey).count(), survey))
+    for name, queryset in access_paths(survey):
+        sys.stdout.write('%s: %.2fms\n%s\n\n' %
+                (name, time_query(queryset), explain(queryset)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]))
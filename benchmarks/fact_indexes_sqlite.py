@@ -0,0 +1,104 @@
+"""Show query plans and latencies for the hot Fact lookups that
+fact_indexes.py measures, on a synthetic in-memory SQLite table, with the
+indexes before migration 0004, with those it first added, and with those
+it adds now. Only the standard library is needed, so the results can be
+reproduced anywhere; run fact_indexes.py against realistic data for
+numbers from a production database.
+
+    python benchmarks/fact_indexes_sqlite.py > benchmarks/fact_indexes_results.txt
+"""
+import random
+import sqlite3
+import sys
+import time
+
+REPEATS = 50
+SURVEYS = 3
+SUBJECTS = 4000
+DESIRED_FACTS = 60
+FACTS_PER_SUBJECT = 15
+
+# the indexes of migrations 0001 (foreign keys) and 0002
+BASE_INDEXES = ['survey_id', 'desired_fact_id', 'content_type_id',
+        'created_by_id', 'updated_by_id',
+        'survey_id, desired_fact_id, numeric_data']
+STATES = [
+    ('before 0004', []),
+    ('0004 as first added', [
+        'survey_id, content_type_id, object_id, desired_fact_id',
+        'survey_id, desired_fact_id, data']),
+    ('0004 without the data index', [
+        'survey_id, content_type_id, object_id, desired_fact_id']),
+]
+
+SELECT = 'SELECT * FROM survey_fact WHERE '
+ACCESS_PATHS = [
+    ('existing_facts / _do_export / has_required_data', SELECT +
+        'survey_id = 2 AND content_type_id = 7 AND object_id = 1234'),
+    ('create_or_update', SELECT + 'survey_id = 2 AND content_type_id = 7 '
+        'AND object_id = 1234 AND desired_fact_id = 25'),
+    ('get_subjects by value', SELECT +
+        "survey_id = 2 AND desired_fact_id = 25 AND data = 'option 07'"),
+    ('get_subjects by range', SELECT +
+        'survey_id = 2 AND desired_fact_id = 5 AND numeric_data > 480'),
+]
+
+
+def facts():
+    """Yield fact rows: the first third of the desired facts are numeric,
+    the rest choices.
+    """
+    random.seed(1)
+    pk = 0
+    for survey in range(1, SURVEYS + 1):
+        for subject in range(1, SUBJECTS + 1):
+            for desired_fact in random.sample(range(1, DESIRED_FACTS + 1),
+                    FACTS_PER_SUBJECT):
+                pk += 1
+                if desired_fact <= DESIRED_FACTS // 3:
+                    data = str(random.randint(0, 500))
+                    numeric_data = float(data)
+                else:
+                    data = 'option %02d' % random.randint(1, 12)
+                    numeric_data = None
+                yield (pk, survey, desired_fact, data, numeric_data, 7,
+                        subject, 1, '2013-01-01', 1, '2013-01-01')
+
+
+def build(indexes):
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE survey_fact (id integer PRIMARY KEY, '
+            'survey_id integer NOT NULL, desired_fact_id integer NOT NULL, '
+            'data varchar(1024) NOT NULL, numeric_data real, '
+            'content_type_id integer NOT NULL, object_id integer NOT NULL, '
+            'created_by_id integer NOT NULL, created_on datetime NOT NULL, '
+            'updated_by_id integer NOT NULL, updated_on datetime NOT NULL)')
+    db.executemany('INSERT INTO survey_fact VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', facts())
+    for i, columns in enumerate(BASE_INDEXES + indexes):
+        db.execute('CREATE INDEX survey_fact_%d ON survey_fact (%s)' %
+                (i, columns))
+    db.execute('ANALYZE')
+    return db
+
+
+def main():
+    sys.stdout.write('SQLite %s, %d facts in %d surveys\n\n' %
+            (sqlite3.sqlite_version,
+             SURVEYS * SUBJECTS * FACTS_PER_SUBJECT, SURVEYS))
+    for state, indexes in STATES:
+        sys.stdout.write('== %s ==\n\n' % state)
+        db = build(indexes)
+        for name, sql in ACCESS_PATHS:
+            start = time.time()
+            for i in range(REPEATS):
+                rows = db.execute(sql).fetchall()
+            latency = (time.time() - start) * 1000 / REPEATS
+            plan = '; '.join(row[-1]
+                    for row in db.execute('EXPLAIN QUERY PLAN ' + sql))
+            sys.stdout.write('%s: %.3fms, %d rows\n%s\n\n' %
+                    (name, latency, len(rows), plan))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,49 @@
 """Create the desired facts from a structured python dictionary. This
 allows surveys to be defined in code.
 """
-from survey.models import (DesiredFactGroup, DesiredFact, SurveyDesiredFact,
-        FactOption)
+from collections import OrderedDict
 
+from django.db import transaction
 
-def create_desired_facts(survey, desired_facts_defns):
+from survey.models import (Survey, DesiredFactGroup, DesiredFact,
+        SurveyDesiredFact, FactOption, batches, options_by_desired_fact,
+        increment_schema_version, rebuild_progress, recompute_numeric_data)
+
+CREATE, UPDATE = 'create', 'update'
+# the optional fields of a desired fact definition, and their defaults
+DESIRED_FACT_DEFAULTS = (
+    ('help_text', ''),
+    ('data_type', 'S'),
+    ('required', True),
+)
+
+
+class ChangeReport(object):
+    """The changes create_desired_facts made to a survey's definition, or
+    would make in a dry run. Each change is an (action, kind, key, fields)
+    tuple: action is CREATE or UPDATE, kind the model's name, and key
+    identifies the object by heading or code. fields maps field names to
+    new values, or for updates to (old, new) pairs.
+    """
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.changes = []
+
+    def add(self, action, kind, key, fields):
+        self.changes.append((action, kind, key, fields))
+
+    def count(self, action, kind):
+        return len([change for change in self.changes
+                if change[:2] == (action, kind)])
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __unicode__(self):
+        return u'\n'.join(u'%s %s %s: %s' % change for change in self.changes)
+
+
+def create_desired_facts(survey, desired_facts_defns, dry_run=False):
     """
     desired_facts_defns has the format:
     {
@@ -22,29 +60,175 @@ def create_desired_facts(survey, desired_facts_defns):
         ...
     }
 
+    Desired facts are matched to existing ones by content type and code,
+    preferring those already in the survey, options by code, and groups by
+    heading, so reloading a changed definition updates labels and the like
+    rather than duplicating them. Existing definitions are loaded and
+    changes applied with bulk queries in one transaction. Nothing is
+    deleted, and existing groups are left as they are.
+
+    Desired facts may be shared with other surveys, and changes to them
+    apply to every survey using them: facts' numeric data is recomputed
+    when a data type changes, and the progress counters of every survey
+    using a desired fact whose required flag changes are rebuilt.
+
+    Return a ChangeReport. With dry_run, nothing is written.
+    """
+    groups, dfs, options, sdfs = _flatten(desired_facts_defns)
+    report = ChangeReport(dry_run)
+
+    existing_groups = {}
+    for headings in batches(list(groups)):
+        for group in DesiredFactGroup.objects.filter(heading__in=headings)\
+                .order_by('pk'):
+            existing_groups.setdefault(group.heading, group)
+    existing_sdfs = dict(((sdf.desired_fact.content_type_id,
+                sdf.desired_fact.code), sdf)
+            for sdf in SurveyDesiredFact.objects.filter(survey=survey)
+                .select_related('desired_fact', 'fact_group'))
+    existing_dfs = dict((key, sdf.desired_fact)
+            for key, sdf in existing_sdfs.items())
+    for codes in batches(list(set(code for _, code in dfs))):
+        for df in DesiredFact.objects.filter(code__in=codes).order_by('pk'):
+            existing_dfs.setdefault((df.content_type_id, df.code), df)
+    existing_options = dict((df_id, dict((fo.code, fo) for fo in fos))
+            for df_id, fos in options_by_desired_fact(df.id for key, df
+                in existing_dfs.items() if key in dfs).items())
+
+    new_groups = []
+    for heading, weight in groups.items():
+        if heading not in existing_groups:
+            new_groups.append(DesiredFactGroup(heading=heading, weight=weight))
+            report.add(CREATE, 'DesiredFactGroup', heading, {'weight': weight})
+
+    new_dfs, df_updates = [], []
+    for (content_type_id, code), fields in dfs.items():
+        df = existing_dfs.get((content_type_id, code))
+        if df is None:
+            new_dfs.append(DesiredFact(code=code,
+                    content_type_id=content_type_id, **fields))
+            report.add(CREATE, 'DesiredFact', code, fields)
+        else:
+            changes = _changed_fields(df, fields)
+            if changes:
+                df_updates.append((df, changes))
+                report.add(UPDATE, 'DesiredFact', code, changes)
+
+    new_options, option_updates = [], []
+    for (df_key, code), description in options.items():
+        option = None
+        if df_key in existing_dfs:
+            option = existing_options.get(existing_dfs[df_key].id, {}).get(code)
+        key = '%s %s' % (df_key[1], code)
+        if option is None:
+            new_options.append((df_key, code, description))
+            report.add(CREATE, 'FactOption', key,
+                    {'description': description})
+        else:
+            changes = _changed_fields(option, {'description': description})
+            if changes:
+                option_updates.append((option, changes))
+                report.add(UPDATE, 'FactOption', key, changes)
+
+    new_sdfs, sdf_updates = [], []
+    for df_key, (heading, weight) in sdfs.items():
+        sdf = existing_sdfs.get(df_key)
+        if sdf is None:
+            new_sdfs.append((df_key, heading, weight))
+            report.add(CREATE, 'SurveyDesiredFact', df_key[1],
+                    {'fact_group': heading, 'weight': weight})
+        else:
+            changes = _changed_fields(sdf, {'weight': weight})
+            if sdf.fact_group.heading != heading:
+                changes['fact_group'] = (sdf.fact_group.heading, heading)
+            if changes:
+                sdf_updates.append((sdf, changes))
+                report.add(UPDATE, 'SurveyDesiredFact', df_key[1], changes)
+
+    if dry_run or not report:
+        return report
+
+    with transaction.commit_on_success():
+        if new_groups:
+            DesiredFactGroup.objects.bulk_create(new_groups)
+            for group in DesiredFactGroup.objects.filter(
+                    heading__in=[group.heading for group in new_groups])\
+                    .order_by('pk'):
+                existing_groups.setdefault(group.heading, group)
+
+        if new_dfs:
+            DesiredFact.objects.bulk_create(new_dfs)
+            for codes in batches([df.code for df in new_dfs]):
+                for df in DesiredFact.objects.filter(code__in=codes)\
+                        .order_by('pk'):
+                    existing_dfs.setdefault((df.content_type_id, df.code), df)
+        for df, changes in df_updates:
+            DesiredFact.objects.filter(pk=df.pk).update(**_new_values(changes))
+            if 'data_type' in changes:
+                recompute_numeric_data(df.pk, changes['data_type'][1])
+
+        FactOption.objects.bulk_create([FactOption(code=code,
+                    description=description,
+                    desired_fact=existing_dfs[df_key])
+                for df_key, code, description in new_options])
+        for option, changes in option_updates:
+            FactOption.objects.filter(pk=option.pk)\
+                    .update(**_new_values(changes))
+
+        SurveyDesiredFact.objects.bulk_create([SurveyDesiredFact(
+                    survey=survey, desired_fact=existing_dfs[df_key],
+                    fact_group=existing_groups[heading], weight=weight)
+                for df_key, heading, weight in new_sdfs])
+        for sdf, changes in sdf_updates:
+            values = _new_values(changes)
+            if 'fact_group' in values:
+                values['fact_group'] = existing_groups[values['fact_group']]
+            SurveyDesiredFact.objects.filter(pk=sdf.pk).update(**values)
+
+    # bulk queries don't send the signals that would do this
+    increment_schema_version()
+    # progress counters depend on which desired facts are required, in
+    # every survey using them
+    survey_ids = set()
+    if any(dfs[df_key]['required'] for df_key, _, _ in new_sdfs):
+        survey_ids.add(survey.pk)
+    required_changed = [df.pk for df, changes in df_updates
+            if 'required' in changes]
+    for df_ids in batches(required_changed):
+        survey_ids.update(SurveyDesiredFact.objects
+                .filter(desired_fact__in=df_ids)
+                .values_list('survey', flat=True))
+    for survey_to_rebuild in Survey.objects.filter(pk__in=list(survey_ids)):
+        rebuild_progress(survey_to_rebuild)
+    return report
+
+def _flatten(desired_facts_defns):
+    """Return OrderedDicts of the groups, desired facts, options and survey
+    desired facts in the definitions, keyed by heading, (content type id,
+    code), ((content type id, code), option code) and (content type id,
+    code) respectively.
     """
+    groups, dfs, options, sdfs = (OrderedDict(), OrderedDict(),
+            OrderedDict(), OrderedDict())
     for subject_type, fact_groups in desired_facts_defns.iteritems():
         for weight, fact_group_defn in enumerate(fact_groups):
-            dfg, _ = DesiredFactGroup.objects\
-                    .get_or_create(heading=fact_group_defn['heading'],
-                            defaults={'weight': weight})
+            heading = fact_group_defn['heading']
+            groups.setdefault(heading, weight)
             for weight, d in enumerate(fact_group_defn['desired_facts']):
-                df, _ = DesiredFact.objects.get_or_create(
-                        code=d['code'],
-                        label=d['label'],
-                        help_text=d.get('help_text', None),
-                        data_type=d.get('data_type', 'S'),
-                        required=d.get('required', True),
-                        content_type=subject_type)
-
+                key = (subject_type.pk, d['code'])
+                fields = dict((name, d.get(name, default))
+                        for name, default in DESIRED_FACT_DEFAULTS)
+                fields.update(label=d['label'],
+                        help_text=fields['help_text'] or '')
+                dfs[key] = fields
                 for code, description in d.get('choices', []):
-                    FactOption.objects.get_or_create(
-                            code=code,
-                            description=description,
-                            desired_fact=df)
-
-                SurveyDesiredFact.objects.get_or_create(
-                        survey=survey,
-                        weight=weight,
-                        desired_fact=df,
-                        fact_group=dfg)
+                    options[(key, code)] = description
+                sdfs[key] = (heading, weight)
+    return groups, dfs, options, sdfs
+
+def _changed_fields(obj, fields):
+    return dict((name, (getattr(obj, name), value))
+            for name, value in fields.items() if getattr(obj, name) != value)
+
+def _new_values(changes):
+    return dict((name, new) for name, (old, new) in changes.items())
@@ -1,30 +1,156 @@
+import csv
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
 from collections import OrderedDict, defaultdict
 from datetime import datetime
+from itertools import groupby, izip
+from operator import itemgetter
 from pytz import timezone
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import openpyxl
 from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone as django_timezone
 from django.utils.datastructures import MultiValueDict
 from django.conf import settings
 
 from survey import models
 
 SPREADSHEETS_ROOT = getattr(settings, 'SPREADSHEETS_ROOT', '.')
+EXPORT_CHUNK_SIZE = getattr(settings, 'SURVEY_EXPORT_CHUNK_SIZE', 1000)
+EXPORT_PROCESSES = getattr(settings, 'SURVEY_EXPORT_PROCESSES', 1)
+# how many subjects are exported between progress reports
+EXPORT_PROGRESS_INTERVAL = getattr(settings,
+        'SURVEY_EXPORT_PROGRESS_INTERVAL', 100)
 TIMEZONE = timezone(settings.TIME_ZONE)
 
-def export_subjects(survey, queryset):
+logger = logging.getLogger(__name__)
+
+def changed_subjects(survey, queryset, since):
+    """Filter queryset to the subjects whose facts in the survey were
+    created, updated or deleted at or after since.
+    """
+    subject_type = ContentType.objects.get_for_model(queryset.model)
+    updated = models.Fact.objects.filter(survey=survey,
+            content_type=subject_type, updated_on__gte=since)
+    deleted = models.FactTombstone.objects.filter(survey=survey,
+            content_type=subject_type, deleted_on__gte=since)
+    return queryset.filter(Q(pk__in=updated.values('object_id')) |
+            Q(pk__in=deleted.values('object_id')))
+
+def last_export_watermark(survey, content_type=None):
+    """Return the watermark of the survey's latest recorded export of all
+    its content types, or None if it has never been exported. With
+    content_type, exports of just that content type count too.
+    """
+    covering = Q(content_type__isnull=True)
+    if content_type is not None:
+        covering |= Q(content_type=content_type)
+    manifests = models.ExportManifest.objects.filter(covering, survey=survey)\
+            .order_by('-watermark')
+    for watermark in manifests.values_list('watermark', flat=True)[:1]:
+        return watermark
+    return None
+
+def export_subjects(survey, queryset, since=None):
     """Return {subject: data_dict, ...} OrderedDict populated with data for
-    each subject in queryset.
+    each subject in queryset, or only those changed at or after since if
+    it's given.
 
     The export data for each subject will be in a MultiValueDict to handle the
     legal case where a subject has multiple facts recorded for a single desired
     fact.
+
+    All facts are fetched in a single query, so the number of queries does not
+    grow with the number of subjects.
     """
     subject_type = ContentType.objects.get_for_model(queryset.model)
-    export_tuples = [(subject, _do_export(survey, subject_type, subject.pk))
+    if since is not None:
+        queryset = changed_subjects(survey, queryset, since)
+    fact_rows = _fact_rows(survey, subject_type,
+            object_ids=queryset.values('pk'))
+    data_by_pk = dict(_group_fact_rows(fact_rows))
+    export_tuples = [(subject, data_by_pk.get(subject.pk, MultiValueDict()))
             for subject in queryset]
     return OrderedDict(export_tuples)
 
+def iter_export_subjects(survey, queryset, chunk_size=EXPORT_CHUNK_SIZE,
+        since=None):
+    """Yield (subject, data_dict) pairs for each subject in queryset, or only
+    those changed at or after since if it's given, in primary key order.
+
+    Subjects are fetched chunk_size at a time, along with their facts, so
+    memory use is bounded by the chunk size rather than by the number of
+    subjects. The result can be returned from ExcelExport.get_subjects_data.
+    """
+    subject_type = ContentType.objects.get_for_model(queryset.model)
+    if since is not None:
+        queryset = changed_subjects(survey, queryset, since)
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        subjects = list(chunk[:chunk_size])
+        if not subjects:
+            return
+
+        # select the chunk's subjects with a subquery rather than a list of
+        # ids, which could exceed the database's parameter limit
+        pks = [subject.pk for subject in subjects]
+        chunk_pks = queryset.filter(pk__gte=pks[0], pk__lte=pks[-1])\
+                .values('pk')
+        fact_rows = _fact_rows(survey, subject_type, object_ids=chunk_pks)
+        data_by_pk = dict(_group_fact_rows(fact_rows))
+        for subject in subjects:
+            yield subject, data_by_pk.get(subject.pk, MultiValueDict())
+        last_pk = pks[-1]
+
+def survey_subjects(survey, content_type, since=None):
+    """Return a queryset of the subjects of the content type with facts in
+    the survey or, if since is given, of those changed at or after since, as
+    changed_subjects finds them.
+    """
+    queryset = content_type.model_class().objects.all()
+    if since is not None:
+        # includes subjects whose facts have all been deleted since
+        return changed_subjects(survey, queryset, since)
+    facts = models.Fact.objects.filter(survey=survey,
+            content_type=content_type)
+    return queryset.filter(pk__in=facts.values('object_id'))
+
+def iter_survey_subjects(survey, content_type, chunk_size=EXPORT_CHUNK_SIZE,
+        since=None):
+    """Stream the data for the survey_subjects of the content type, as
+    iter_export_subjects does, with the model's survey_identifiers
+    attributes added to the fact data.
+    """
+    identifiers = getattr(content_type.model_class(), 'survey_identifiers', [])
+    subjects_data = iter_export_subjects(survey,
+            survey_subjects(survey, content_type, since=since),
+            chunk_size=chunk_size)
+    for subject, data in subjects_data:
+        for identifier in identifiers:
+            data.setlist(identifier, [getattr(subject, identifier)])
+        yield subject, data
+
+def count_subjects(survey, content_types, since=None):
+    """Return the number of subjects of these content types an export
+    would include.
+    """
+    return sum(survey_subjects(survey, content_type, since=since).count()
+            for content_type in content_types)
+
 def export_subject(survey, subject):
     """Return a {code: data, ...} dict populated with data for this subject,
     with the data in a MultiValueDict.
@@ -42,35 +168,129 @@ def _do_export(survey, subject_type, pk):
         export_data.appendlist(fact.desired_fact.code, fact.data)
     return export_data
 
-def generate_spreadsheet_definition(survey):
-    sdfs = survey.surveydesiredfact_set.all()\
-            .select_related('desired_fact', 'fact_group')\
-            .order_by('weight')
+def _fact_rows(survey, subject_type, object_ids=None):
+    """Return an iterator over (object_id, code, data) tuples for all facts
+    of this type in the survey, ordered by subject.
+    """
+    facts = models.Fact.objects\
+            .filter(survey=survey, content_type=subject_type)
+    if object_ids is not None:
+        facts = facts.filter(object_id__in=object_ids)
+    return facts.order_by('object_id', 'id')\
+            .values_list('object_id', 'desired_fact__code', 'data')\
+            .iterator()
 
-    dfs_by_type = defaultdict(set)
-    dfs_by_group = defaultdict(list)
-    for sdf in sdfs:
-        df = sdf.desired_fact
-        dfs_by_type[df.content_type].add(df)
-        dfs_by_group[sdf.fact_group].append(df)
+def _group_fact_rows(fact_rows):
+    """Group (object_id, code, data) rows, which must be ordered by
+    object_id, into (object_id, MultiValueDict) pairs.
+    """
+    for object_id, rows in groupby(fact_rows, key=itemgetter(0)):
+        export_data = MultiValueDict()
+        for _, code, data in rows:
+            export_data.appendlist(code, data)
+        yield object_id, export_data
 
+def generate_spreadsheet_definition(survey):
+    """Return a spreadsheet definition for ExcelExport with a worksheet for
+    each group of each content type in the survey's schema.
+    """
     spreadsheet = defaultdict(list)
-    for content_type, dfs_for_type in dfs_by_type.iteritems():
-        for group, group_dfs in dfs_by_group.iteritems():
-            codes = [df.code for df in group_dfs if df in dfs_for_type]
-            if codes:
-                try:
-                    model = content_type.model_class()
-                    codes = model.survey_identifiers + codes
-                except AttributeError:
-                    pass
-                spreadsheet[content_type].append({
-                    'title': group.heading[:30], # max worksheet title length
-                    'codes': codes
-                })
+    for content_type_id, schema in models.survey_schema(survey)\
+            .content_types.iteritems():
+        content_type = ContentType.objects.get_for_id(content_type_id)
+        identifiers = list(getattr(content_type.model_class(),
+                'survey_identifiers', []))
+        for group in schema.groups:
+            spreadsheet[content_type].append({
+                'title': group.heading[:30], # max worksheet title length
+                'codes': identifiers + [df.code for df in group.desired_facts]
+            })
     return spreadsheet
 
-class ExcelExport(object):
+class SpreadsheetExport(object):
+    """Turns subjects' export data into rows of cells according to a
+    spreadsheet definition. Subclasses decide where the rows go.
+    """
+    def __init__(self, spreadsheet_defn, output_translations=None,
+            allow_blank=None, multi_row_data=None, on_progress=None):
+
+        self.spreadsheet_defn = spreadsheet_defn
+        self.output_translations = output_translations or {}
+        self.allow_blank = set(allow_blank or [])
+        self.multi_row_data = multi_row_data or {}
+        self.on_progress = on_progress
+
+    def report_progress(self, subjects_done):
+        """Pass the number of subjects exported since the last report to
+        on_progress, if given. May be called from export worker processes.
+        """
+        if self.on_progress is not None:
+            self.on_progress(subjects_done)
+
+    def iter_counting(self, subjects_data):
+        """Iterate over (subject, data) pairs, reporting progress every
+        EXPORT_PROGRESS_INTERVAL subjects and at the end.
+        """
+        done = 0
+        for subject, data in self.iter_subjects_data(subjects_data):
+            yield subject, data
+            done += 1
+            if done == EXPORT_PROGRESS_INTERVAL:
+                self.report_progress(done)
+                done = 0
+        if done:
+            self.report_progress(done)
+
+    def make_header_row(self, header_row, translations):
+        final_header_row = []
+        for heading in header_row:
+            if isinstance(heading, dict):
+                heading = heading['code']
+            final_header_row.append(translations.get(heading, heading))
+        return final_header_row
+
+    def make_cell(self, data, code, **kwargs):
+        return self.format_cell(data.getlist(code), code)
+
+    def format_cell(self, values, code):
+        if values == []:
+            if not self.allow_blank or code in self.allow_blank:
+                values = ['']
+            else:
+                values = ['0']
+
+        return ', '.join(map(str, values))
+
+    def make_row(self, data, codes, **kwargs):
+        return [self.make_cell(data, code, **kwargs) for code in codes]
+
+    def make_multi_rows(self, multi_key, data, codes):
+        """Return one row for each of the subject's values for multi_key.
+        Columns with several values are zipped with multi_key's values by
+        position, and other columns are repeated on every row. data is not
+        modified.
+        """
+        count = len(data.getlist(multi_key))
+        columns = []
+        for code in codes:
+            values = data.getlist(code)
+            if code == multi_key or len(values) > 1:
+                columns.append([self.format_cell(values[i:i + 1], code)
+                        for i in range(count)])
+            else:
+                columns.append([self.make_cell(data, code)] * count)
+        return [[column[i] for column in columns] for i in range(count)]
+
+    def iter_subjects_data(self, subjects_data):
+        if hasattr(subjects_data, 'iteritems'):
+            return subjects_data.iteritems()
+        return iter(subjects_data)
+
+    def get_subjects_data(self, content_type):
+        raise NotImplementedError
+
+
+class ExcelExport(SpreadsheetExport):
     """
     Takes a spreadsheet definition in the following form and uses it to output
     an Excel spreadsheet containing data for the given survey.
@@ -86,15 +306,35 @@ class ExcelExport(object):
             },
             ...
         }
+
+    Subclasses implement get_subjects_data(content_type), which may return
+    either a {subject: data, ...} mapping such as export_subjects produces,
+    or an iterable of (subject, data) pairs such as iter_export_subjects
+    produces. The latter is streamed straight into the write-only worksheet,
+    so the whole survey is never held in memory.
+
+    With processes greater than 1, worksheet rows are built in a pool of
+    that many forked processes, each with its own database connections.
+    Workers write rows to temporary files, which are appended to the
+    workbook in the same order as the serial path.
+
+    For a delta export, pass since, e.g. from last_export_watermark, and
+    have get_subjects_data pass self.since on to export_subjects or
+    iter_export_subjects. If survey is given, each export is recorded in an
+    ExportManifest whose watermark is the time the export started, so
+    changes made while it runs are included in the next delta.
     """
     def __init__(self, spreadsheet_defn, output_translations=None,
-            allow_blank=None, multi_row_data=None):
+            allow_blank=None, multi_row_data=None, processes=None,
+            survey=None, since=None, on_progress=None):
 
+        super(ExcelExport, self).__init__(spreadsheet_defn,
+                output_translations=output_translations,
+                allow_blank=allow_blank, multi_row_data=multi_row_data,
+                on_progress=on_progress)
         self.workbook = openpyxl.Workbook(optimized_write=True)
-        self.spreadsheet_defn = spreadsheet_defn
-        self.output_translations = output_translations or {}
-        self.allow_blank = set(allow_blank or [])
-        self.multi_row_data = multi_row_data or {}
+        self.processes = processes or EXPORT_PROCESSES
+        self.survey, self.since = survey, since
 
     def _filename(self):
         now = TIMEZONE.localize(datetime.now())
@@ -104,65 +344,301 @@ class ExcelExport(object):
     def create_worksheet(self, title, header_row, translations):
         worksheet = self.workbook.create_sheet()
         worksheet.title = title
-
-        final_header_row = []
-        for heading in header_row:
-            if isinstance(heading, dict):
-                heading = heading['code']
-            final_header_row.append(translations.get(heading, heading))
-        worksheet.append(final_header_row)
+        worksheet.append(self.make_header_row(header_row, translations))
 
         return worksheet
 
-    def make_cell(self, data, code, **kwargs):
-        values = data.getlist(code)
-        if values == []:
-            if not self.allow_blank or code in self.allow_blank:
-                values = ['']
-            else:
-                values = ['0']
-
-        return ', '.join(map(str, values))
-
-    def make_row(self, data, codes, **kwargs):
-        return [self.make_cell(data, code, **kwargs) for code in codes]
-
-    def make_multi_rows(self, multi_key, data, codes):
-        rows = []
-        while data.getlist(multi_key):
-            rows.append(self.make_row(data, codes))
-            data.getlist(multi_key).pop()
-        return rows
-
     def append_row(self, worksheet, row_data):
         worksheet.append(row_data)
 
-    def output_data(self, worksheet, title, codes, subjects_data):
+    def make_sheet_rows(self, title, codes, data):
+        """Return the rows for one subject's data in a worksheet."""
         if title in self.multi_row_data:
-            multi_key = self.multi_row_data[title]
-            for subject, data in subjects_data.iteritems():
-                for row in self.make_multi_rows(multi_key, data, codes):
-                    self.append_row(worksheet, row)
+            return self.make_multi_rows(self.multi_row_data[title], data,
+                    codes)
+        return [self.make_row(data, codes)]
+
+    def iter_sheet_rows(self, title, codes, subjects_data):
+        for subject, data in self.iter_subjects_data(subjects_data):
+            for row in self.make_sheet_rows(title, codes, data):
+                yield row
+
+    def iter_rows_by_sheet(self, sheets, subjects_data, counting=True):
+        """Yield (sheet_index, row) for every row of every one of sheets, a
+        list of (title, codes) pairs, in a single pass over subjects_data.
+        Progress is reported unless counting is False.
+        """
+        if counting:
+            subjects_data = self.iter_counting(subjects_data)
         else:
-            for subject, data in subjects_data.iteritems():
-                self.append_row(worksheet, self.make_row(data, codes))
+            subjects_data = self.iter_subjects_data(subjects_data)
+        for subject, data in subjects_data:
+            for index, (title, codes) in enumerate(sheets):
+                for row in self.make_sheet_rows(title, codes, data):
+                    yield index, row
+
+    def output_data(self, worksheet, title, codes, subjects_data):
+        for row in self.iter_sheet_rows(title, codes, subjects_data):
+            self.append_row(worksheet, row)
+
+    def content_type_tasks(self):
+        """Return [(content_type, [(title, codes), ...]), ...] in output
+        order.
+        """
+        return [(content_type, [(sheet_defn['title'], sheet_defn['codes'])
+                    for sheet_defn in sheet_defns])
+                for content_type, sheet_defns in self.spreadsheet_defn.iteritems()]
 
-    def get_subjects_data(content_type):
-        raise NotImplemented
+    def iter_content_types(self):
+        """Yield (content_type, sheets, rows) for every content type, where
+        rows yields (sheet_index, row) pairs. Each content type's subject
+        data is fetched once and shared by all of its worksheets.
 
-    def do_export(self):
-        for content_type, sheet_defns in self.spreadsheet_defn.iteritems():
-            for sheet_defn in sheet_defns:
-                codes, title = sheet_defn['codes'], sheet_defn['title']
+        Rows are built in this process or, if processes > 1, in a pool of
+        worker processes.
+        """
+        tasks = self.content_type_tasks()
+        if self.processes > 1 and sum(len(sheets) for _, sheets in tasks) > 1:
+            for content_type_rows in self._iter_content_types_parallel(tasks):
+                yield content_type_rows
+            return
 
-                trans = self.output_translations.get(title, {})
-                worksheet = self.create_worksheet(title, codes, trans)
+        for content_type, sheets in tasks:
+            subjects_data = self.get_subjects_data(content_type)
+            yield content_type, sheets, self.iter_rows_by_sheet(sheets,
+                    subjects_data)
 
-                subjects_data = self.get_subjects_data(content_type)
-                self.output_data(worksheet, title, codes, subjects_data)
+    def _iter_content_types_parallel(self, tasks):
+        """Build rows in two stages: workers fetch each content type's
+        subject data once, writing it to a temporary file, then each
+        content type's worksheets are split between the workers, which
+        read the data back. So a survey with one content type but many
+        worksheets still uses every worker, at the cost of writing the
+        subject data to disk and reading it once per group of worksheets.
+        """
+        global _worker_export
+        # forked workers inherit the export, so it needn't be picklable.
+        # They write data and rows files into one directory, which is
+        # removed however the export ends, even if it's abandoned or a
+        # worker fails
+        _worker_export, self._tasks = self, tasks
+        self._rows_dir = tempfile.mkdtemp(suffix='.rows')
+        processes = min(self.processes,
+                max(len(tasks), max(len(sheets) for _, sheets in tasks)))
+        pool = multiprocessing.Pool(processes,
+                initializer=_init_export_worker)
+        try:
+            data_paths = pool.map(_fetch_content_type_data, range(len(tasks)))
+            # [(task index, data path, [sheet index, ...]), ...], with each
+            # content type's groups together, in output order
+            groups = [(index, data_paths[index],
+                        range(first, len(sheets), processes))
+                    for index, (content_type, sheets) in enumerate(tasks)
+                    for first in range(min(processes, len(sheets)))]
+            results = izip(groups, pool.imap(_build_sheet_group_rows, groups))
+            for index, group_results in groupby(results,
+                    key=lambda result: result[0][0]):
+                content_type, sheets = tasks[index]
+                paths = [None] * len(sheets)
+                for (_, _, sheet_indexes), group_paths in group_results:
+                    for sheet_index, path in zip(sheet_indexes, group_paths):
+                        paths[sheet_index] = path
+                os.remove(data_paths[index])
+                yield content_type, sheets, _read_rows_by_sheet(paths)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(self._rows_dir, ignore_errors=True)
+            _worker_export, self._tasks, self._rows_dir = None, None, None
 
-        filename = self._filename()
+# database connections inherited by a worker, kept referenced so that they
+# are never closed, which would close the parent's connections too
+_inherited_connections = []
+
+def _init_export_worker():
+    for connection in connections.all():
+        _inherited_connections.append(connection.connection)
+        connection.connection = None
+
+def _iter_pickled(path):
+    """Yield the objects pickled one after another into the file at path."""
+    with open(path, 'rb') as pickled_file:
+        while True:
+            try:
+                yield pickle.load(pickled_file)
+            except EOFError:
+                return
+
+def _fetch_content_type_data(index):
+    """Write one of _worker_export's content types' (subject, data) pairs
+    to a temporary file, reporting progress. Return the file's path.
+    """
+    content_type, sheets = _worker_export._tasks[index]
+    fd, path = tempfile.mkstemp(suffix='.data', dir=_worker_export._rows_dir)
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as data_file:
+            subjects_data = _worker_export.get_subjects_data(content_type)
+            for pair in _worker_export.iter_counting(subjects_data):
+                pickle.dump(pair, data_file, pickle.HIGHEST_PROTOCOL)
+        completed = True
+    finally:
+        if not completed:
+            os.remove(path)
+    return path
+
+def _build_sheet_group_rows(group):
+    """Build the rows for a group of one content type's worksheets from
+    the data written by _fetch_content_type_data, writing each worksheet's
+    rows to a temporary file. group is (task index, data path, [sheet
+    index, ...]). Return the files' paths, in the order of the group.
+    """
+    index, data_path, sheet_indexes = group
+    content_type, sheets = _worker_export._tasks[index]
+    sheets = [sheets[sheet_index] for sheet_index in sheet_indexes]
+    rows_files, paths = [], []
+    completed = False
+    try:
+        for sheet in sheets:
+            fd, path = tempfile.mkstemp(suffix='.rows',
+                    dir=_worker_export._rows_dir)
+            rows_files.append(os.fdopen(fd, 'wb'))
+            paths.append(path)
+        rows = _worker_export.iter_rows_by_sheet(sheets,
+                _iter_pickled(data_path), counting=False)
+        for sheet_index, row in rows:
+            pickle.dump(row, rows_files[sheet_index], pickle.HIGHEST_PROTOCOL)
+        completed = True
+    finally:
+        for rows_file in rows_files:
+            rows_file.close()
+        if not completed:
+            for path in paths:
+                os.remove(path)
+    return paths
+
+def _read_rows_by_sheet(paths):
+    """Yield (sheet_index, row) for the rows written to each of paths by
+    _build_sheet_group_rows, removing each file once read, and the rest
+    if the generator is closed or fails part way through.
+    """
+    try:
+        for index, path in enumerate(paths):
+            for row in _iter_pickled(path):
+                yield index, row
+            os.remove(path)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class _Echo(object):
+    """A file-like object that returns what is written to it, so that a csv
+    writer can produce lines one at a time.
+    """
+    def write(self, value):
+        return value
+
+
+class CsvExport(SpreadsheetExport):
+    """Produces one content type's data in a survey as lines of CSV, or of
+    TSV with delimiter='\\t', lazily so that they can be streamed.
+
+    The columns are the codes of all the spreadsheet definition's sheets
+    for the content type, which defaults to the survey's definition from
+    generate_spreadsheet_definition. Output translations for all sheets
+    apply to the header row. With since, only subjects changed at or after
+    it are included.
+    """
+    def __init__(self, survey, content_type, delimiter=',',
+            spreadsheet_defn=None, output_translations=None, allow_blank=None,
+            chunk_size=EXPORT_CHUNK_SIZE, since=None, on_progress=None):
+
+        if spreadsheet_defn is None:
+            spreadsheet_defn = generate_spreadsheet_definition(survey)
+        super(CsvExport, self).__init__(spreadsheet_defn,
+                output_translations=output_translations,
+                allow_blank=allow_blank, on_progress=on_progress)
+        self.survey, self.content_type = survey, content_type
+        self.delimiter, self.chunk_size = delimiter, chunk_size
+        self.since = since
+
+    def codes(self):
+        codes = []
+        for sheet_defn in self.spreadsheet_defn.get(self.content_type, []):
+            codes.extend(code for code in sheet_defn['codes']
+                    if code not in codes)
+        return codes
+
+    def translations(self):
+        translations = {}
+        for sheet_defn in self.spreadsheet_defn.get(self.content_type, []):
+            translations.update(
+                    self.output_translations.get(sheet_defn['title'], {}))
+        return translations
+
+    def get_subjects_data(self, content_type):
+        return iter_survey_subjects(self.survey, content_type,
+                chunk_size=self.chunk_size, since=self.since)
+
+    def iter_rows(self):
+        codes = self.codes()
+        yield self.make_header_row(codes, self.translations())
+        subjects_data = self.get_subjects_data(self.content_type)
+        for subject, data in self.iter_counting(subjects_data):
+            yield self.make_row(data, codes)
+
+    def iter_lines(self):
+        writer = csv.writer(_Echo(), delimiter=self.delimiter)
+        for row in self.iter_rows():
+            yield writer.writerow(row)
+
+    def do_export(self, filename=None):
+        """Write the lines to a file in SPREADSHEETS_ROOT, and record the
+        export in an ExportManifest for the content type, as ExcelExport
+        does for the whole survey.
+        """
+        watermark = django_timezone.now()
+        if filename is None:
+            now = TIMEZONE.localize(datetime.now())
+            filename = '{model}_export__{date}.{ext}'.format(
+                    model=self.content_type.model,
+                    date=now.strftime('%Y_%m_%d_%H%M'),
+                    ext='tsv' if self.delimiter == '\t' else 'csv')
         path = ''.join([SPREADSHEETS_ROOT, '/', filename])
-        self.workbook.save(filename=path)
+        with open(path, 'wb') as output:
+            for line in self.iter_lines():
+                output.write(line)
+        models.ExportManifest.objects.create(survey=self.survey,
+                content_type=self.content_type, filename=filename,
+                since=self.since, watermark=watermark)
         return filename, path
 
+
+def run_export_job(job):
+    """Run a claimed ExportJob, recording its progress as it goes, then the
+    file it was written to or the error that stopped it. The error's
+    traceback is logged.
+    """
+    try:
+        if job.format == models.XLSX:
+            export = SurveyExcelExport(job.survey, since=job.since,
+                    on_progress=job.add_progress)
+            content_types = export.spreadsheet_defn.keys()
+        else:
+            export = CsvExport(job.survey, job.content_type,
+                    delimiter='\t' if job.format == models.TSV else ',',
+                    since=job.since, on_progress=job.add_progress)
+            content_types = [job.content_type]
+        job.start(count_subjects(job.survey, content_types, since=job.since))
+        filename, path = export.do_export(filename=job.output_filename())
+    except Exception as e:
+        logger.exception('Export job %s failed', job.pk)
+        # a database error leaves the transaction unusable, on PostgreSQL at
+        # least, until it's rolled back
+        transaction.rollback_unless_managed()
+        # the traceback is logged, but only the error is shown to users
+        job.fail(traceback.format_exception_only(type(e), e)[-1].strip())
+    else:
+        job.finish(filename)
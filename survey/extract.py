@@ -0,0 +1,115 @@
+"""Extract survey data into NumPy arrays, one column per desired fact, so
+that statistics can be computed without reshaping exported dicts. NumPy
+must be installed to use this module.
+"""
+from collections import OrderedDict
+
+import numpy
+from numpy import ma
+
+from survey import models
+
+
+class SurveyTable(object):
+    """Survey data for subjects of one content type, with one row per
+    subject that has facts and one column per desired fact code.
+
+    subject_ids is an integer array of the subjects' primary keys, and
+    columns maps codes to arrays, typed by the desired fact's data type:
+
+    INT, FLOAT: float arrays, with NaN where there's no fact
+    YES_NO: masked boolean arrays, masked where there's no fact
+    SELECT: integer arrays of indexes into categories[code], or -1
+    TEXT: object arrays of strings, or None
+    MULTI: object arrays of lists of option codes, or None
+    """
+    def __init__(self, subject_ids, columns, categories):
+        self.subject_ids = subject_ids
+        self.columns = columns
+        self.categories = categories
+
+    def __getitem__(self, code):
+        return self.columns[code]
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+
+def _empty_column(data_type, size):
+    if data_type in (models.INT, models.FLOAT):
+        column = numpy.empty(size, dtype=float)
+        column.fill(numpy.nan)
+        return column
+    if data_type == models.YES_NO:
+        return ma.masked_all(size, dtype=bool)
+    if data_type == models.SELECT:
+        column = numpy.empty(size, dtype=numpy.int32)
+        column.fill(-1)
+        return column
+    return numpy.empty(size, dtype=object)
+
+
+def extract_table(survey, content_type):
+    """Return a SurveyTable of the survey's data for subjects of
+    content_type. Facts are read in a single streaming pass.
+    """
+    sdfs = models.SurveyDesiredFact.objects\
+            .filter(survey=survey, desired_fact__content_type=content_type)\
+            .select_related('desired_fact')\
+            .order_by('fact_group__weight', 'weight', 'desired_fact__code')
+    desired_facts = dict((sdf.desired_fact.id, sdf.desired_fact)
+            for sdf in sdfs)
+
+    facts = models.Fact.objects.filter(survey=survey,
+            content_type=content_type).order_by()
+    size = facts.values('object_id').distinct().count()
+
+    options = models.options_by_desired_fact(df.id
+            for df in desired_facts.values() if df.data_type == models.SELECT)
+    categories = dict((df.code, [fo.code for fo in options[df.id]])
+            for df in desired_facts.values() if df.data_type == models.SELECT)
+    category_indexes = dict((code, dict((c, i) for i, c in enumerate(cs)))
+            for code, cs in categories.items())
+
+    subject_ids = numpy.zeros(size, dtype=numpy.int64)
+    columns = dict((df.id, _empty_column(df.data_type, size))
+            for df in desired_facts.values())
+
+    rows = facts.order_by('object_id', 'id')\
+            .values_list('object_id', 'desired_fact_id', 'data').iterator()
+    row, last_object_id = -1, None
+    for object_id, desired_fact_id, data in rows:
+        if object_id != last_object_id:
+            row += 1
+            if row == size:
+                # facts for new subjects were written since counting
+                break
+            subject_ids[row], last_object_id = object_id, object_id
+
+        desired_fact = desired_facts.get(desired_fact_id)
+        if desired_fact is None:
+            continue
+        column, data_type = columns[desired_fact_id], desired_fact.data_type
+        if data_type in (models.INT, models.FLOAT):
+            value = models.numeric_value(data_type, data)
+            column[row] = numpy.nan if value is None else value
+        elif data_type == models.YES_NO:
+            column[row] = models.numeric_value(data_type, data) == 1
+        elif data_type == models.SELECT:
+            indexes = category_indexes[desired_fact.code]
+            if data not in indexes:
+                indexes[data] = len(indexes)
+                categories[desired_fact.code].append(data)
+            column[row] = indexes[data]
+        elif data_type == models.MULTI:
+            if column[row] is None:
+                column[row] = []
+            column[row].append(data)
+        else:
+            column[row] = data
+
+    # fewer subjects if facts were deleted since counting
+    size = min(row + 1, size)
+    columns = OrderedDict((sdf.desired_fact.code,
+            columns[sdf.desired_fact.id][:size]) for sdf in sdfs)
+    return SurveyTable(subject_ids[:size], columns, categories)
@@ -1,12 +1,16 @@
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
+from threading import Lock
 
 from django import forms
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.forms.util import ErrorDict
 from form_utils.forms import BetterForm
 
 from survey import models
 
+FORM_CLASS_CACHE_SIZE = getattr(settings, 'SURVEY_FORM_CLASS_CACHE_SIZE', 100)
+
 
 class FactField(forms.Field):
     FACT_FIELD_CLASS = 'factFormField'
@@ -71,27 +75,31 @@ class FloatFactField(FactField, forms.FloatField):
 class ChoiceFactField(FactField, forms.ChoiceField):
     html_class = 'select'
 
-    def __init__(self, desired_fact, *args, **kwargs):
+    def __init__(self, desired_fact, choices=None, *args, **kwargs):
         kwargs.update(widget=forms.Select)
         super(ChoiceFactField, self)\
                 .__init__(desired_fact, *args, **kwargs)
-        self._set_choices(desired_fact.choices)
+        if choices is None:
+            choices = desired_fact.choices
+        self._set_choices(choices)
 
 
 class MultipleChoiceFactField(FactField, forms.MultipleChoiceField):
     html_class = 'multi-select'
 
-    def __init__(self, desired_fact, *args, **kwargs):
+    def __init__(self, desired_fact, choices=None, *args, **kwargs):
         kwargs.update(widget=forms.SelectMultiple)
         super(MultipleChoiceFactField, self)\
                 .__init__(desired_fact, *args, **kwargs)
-        self._set_choices(desired_fact.choices)
+        if choices is None:
+            choices = desired_fact.choices
+        self._set_choices(choices)
 
     def prep_data_for_saving(self, data):
         return data
 
 
-def fact_field_factory(desired_fact):
+def fact_field_factory(desired_fact, choices=None):
     classes = {
         models.MULTI: MultipleChoiceFactField,
         models.SELECT: ChoiceFactField,
@@ -101,6 +109,8 @@ def fact_field_factory(desired_fact):
         models.TEXT: TextFactField,
     }
     cls = classes.get(desired_fact.data_type, FactField)
+    if choices is not None:
+        return cls(desired_fact, choices=choices)
     return cls(desired_fact)
 
 
@@ -122,45 +132,53 @@ class BaseSurveyForm(BetterForm):
         self._post_clean()
 
     def save_valid(self):
-        """Write any valid facts to the database.
+        """Write any valid facts to the database, with one bulk write unless
+        a subclass overrides create_fact, in which case it's called for
+        each fact.
         """
         content_type = ContentType.objects.get_for_model(self.subject)
 
         all_field_names = set(self.fields.keys())
         error_field_names = set(self.errors.keys())
+        fact_data = []
         for field_name in all_field_names - error_field_names:
             data = self.cleaned_data.get(field_name)
             field = self.fields[field_name]
             data = field.prep_data_for_saving(data)
-            self.create_fact(data, field.desired_fact, content_type)
+            fact_data.append((field.desired_fact, data))
+
+        if _overrides(type(self), 'create_fact'):
+            for desired_fact, data in fact_data:
+                self.create_fact(data, desired_fact, content_type)
+            return
+        models.Fact.bulk_create_or_update(self.survey, content_type,
+                self.subject.id, fact_data, self.user)
 
     def create_fact(self, data, desired_fact, content_type):
         models.Fact.create_or_update(self.survey, desired_fact, content_type,
                 self.subject.id, data, self.user)
 
-def _survey_form_subclass(base_class, survey_desired_facts):
-    """The desired facts for the survey are examined and used to
-    create relevant form fields. We also generate configuration for
-    the form's fieldsets according to the groupings defined in the
+def _overrides(form_class, name):
+    return getattr(form_class, name).__func__ is not \
+            getattr(BaseSurveyForm, name).__func__
+
+def _survey_form_subclass(base_class, groups):
+    """The desired facts in groups, SchemaGroups from the survey's schema,
+    are used to create relevant form fields. We also generate configuration
+    for the form's fieldsets according to the groupings defined in the
     relevant DesiredFactGroup instances.
     """
     form_attrs = OrderedDict()
-    dfs_by_fact_group = defaultdict(list)
     fieldsets = []
-
-    for sdf in survey_desired_facts:
-        field = fact_field_factory(sdf.desired_fact)
-        form_attrs[sdf.desired_fact.code] = field
-        dfs_by_fact_group[sdf.fact_group].append(sdf.desired_fact)
-
-    ordered_fact_groups = sorted(dfs_by_fact_group.iteritems(),
-            key=lambda pair: pair[0].weight)
-    for fact_group, desired_facts in ordered_fact_groups:
+    for group in groups:
+        for desired_fact in group.desired_facts:
+            form_attrs[desired_fact.code] = fact_field_factory(desired_fact,
+                    desired_fact.choices)
         fieldset_opts = {
-            'fields': [df.code for df in desired_facts],
-            'legend': fact_group.heading,
+            'fields': [df.code for df in group.desired_facts],
+            'legend': group.heading,
         }
-        fieldsets.append((fact_group.id, fieldset_opts))
+        fieldsets.append((group.id, fieldset_opts))
 
     class Meta:
         pass
@@ -169,10 +187,30 @@ def _survey_form_subclass(base_class, survey_desired_facts):
     form_attrs.update(Meta=Meta)
     return type('SurveyForm', (base_class,), form_attrs)
 
+_form_class_cache = OrderedDict()
+_form_class_cache_lock = Lock()
+
 def make_survey_form_subclass(survey, content_type):
-    sdfs = models.SurveyDesiredFact.objects\
-            .filter(survey=survey, desired_fact__content_type=content_type)\
-            .select_related('fact_group', 'desired_fact')\
-            .order_by('fact_group__weight', 'weight', 'desired_fact__code')
-    return _survey_form_subclass(BaseSurveyForm, sdfs)
+    """Return the form class for subjects of this content type in the
+    survey. Built classes are kept in a process-local LRU cache, keyed by
+    the schema version so that changes to the survey definition are picked
+    up.
+    """
+    key = (survey.pk, content_type.pk, models.schema_version())
+    with _form_class_cache_lock:
+        form_class = _form_class_cache.pop(key, None)
+        if form_class is not None:
+            _form_class_cache[key] = form_class
+            return form_class
+
+    form_class = _make_survey_form_subclass(survey, content_type)
+    with _form_class_cache_lock:
+        _form_class_cache[key] = form_class
+        while len(_form_class_cache) > FORM_CLASS_CACHE_SIZE:
+            _form_class_cache.popitem(last=False)
+    return form_class
+
+def _make_survey_form_subclass(survey, content_type):
+    schema = models.survey_schema(survey).for_content_type(content_type)
+    return _survey_form_subclass(BaseSurveyForm, schema.groups)
 
@@ -0,0 +1,204 @@
+import csv
+
+import openpyxl
+from django.conf import settings
+from django.forms import ValidationError
+
+from survey import models
+from survey.forms import fact_field_factory
+
+# how many facts are written to the database at a time
+IMPORT_BATCH_SIZE = getattr(settings, 'SURVEY_IMPORT_BATCH_SIZE', 5000)
+
+def iter_csv_rows(csv_file, delimiter=','):
+    """Yield the rows of a CSV or TSV file as lists of unicode strings."""
+    for row in csv.reader(csv_file, delimiter=delimiter):
+        yield [value.decode('utf-8') for value in row]
+
+def iter_workbook_sheets(path):
+    """Yield (title, rows) for each worksheet of an Excel workbook, reading
+    it a row at a time rather than loading the whole workbook.
+    """
+    workbook = openpyxl.load_workbook(filename=path, use_iterators=True)
+    for worksheet in workbook.worksheets:
+        rows = ([cell.internal_value for cell in row]
+                for row in worksheet.iter_rows())
+        yield worksheet.title, rows
+
+def cell_text(value):
+    """The text of a cell, as exported by SpreadsheetExport. Whole numbers
+    read from a workbook as floats lose their decimal point.
+    """
+    if value is None:
+        return u''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unicode(value).strip()
+
+def numbered_option_codes(choices):
+    """Map the numbers that digit-only option codes in choices would become
+    in a spreadsheet, such as u'1' for u'01', to the codes. Numbers that
+    are themselves codes are left out, so they still match exactly.
+    """
+    # YES_NO choices have integer codes
+    codes = set(unicode(code) for code, label in choices)
+    numbered = {}
+    for code in sorted(codes):
+        if code.isdigit() and unicode(int(code)) not in codes:
+            numbered.setdefault(unicode(int(code)), code)
+    return numbered
+
+
+class ImportReport(object):
+    """Counts of what an import did, and the errors it found as (sheet,
+    row number, code, message) tuples. Header rows are row 1.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.created, self.updated, self.deleted = 0, 0, 0
+        self.errors = []
+        self.skipped_sheets = []
+
+    def add_error(self, sheet, row_number, code, message):
+        self.errors.append((sheet, row_number, code, message))
+
+
+class FactImporter(object):
+    """Imports facts for subjects of one content type in a survey from
+    spreadsheets laid out like those generate_spreadsheet_definition
+    describes: a header row of desired fact codes, then a row per subject.
+
+    Subjects are identified by the column named identifier, which defaults
+    to the first of the model's survey_identifiers, or to id. Values are
+    validated by the same FactFields as the survey form, and MULTI values
+    are separated by commas. Option codes that were turned into numbers,
+    such as 1 for 01, are matched to the codes. Blank cells leave facts
+    unchanged. Invalid
+    values and unknown subjects are reported, and the rest of the row is
+    still imported.
+
+    Facts are written batch_size at a time, each batch in one transaction
+    with Fact.bulk_create_or_update_subjects.
+    """
+    def __init__(self, survey, content_type, user, identifier=None,
+            batch_size=IMPORT_BATCH_SIZE):
+        self.survey, self.content_type, self.user = survey, content_type, user
+        self.model = content_type.model_class()
+        if identifier is None:
+            identifier = (getattr(self.model, 'survey_identifiers', None)
+                    or ['id'])[0]
+        self.identifier = identifier
+        self.batch_size = batch_size
+        self.report = ImportReport()
+
+        schema = models.survey_schema(survey).for_content_type(content_type)
+        self.fields = dict((df.code, fact_field_factory(df, df.choices))
+                for df in schema.desired_facts)
+        self.option_codes = dict((df.code, numbered_option_codes(df.choices))
+                for df in schema.desired_facts
+                if df.data_type in models.CHOICE_TYPES)
+
+    def import_csv(self, csv_file, delimiter=','):
+        self.import_sheet('', iter_csv_rows(csv_file, delimiter=delimiter))
+        return self.report
+
+    def import_workbook(self, path):
+        """Import every worksheet with the identifier column. Others, such
+        as the worksheets for other content types, are skipped.
+        """
+        for title, rows in iter_workbook_sheets(path):
+            self.import_sheet(title, rows)
+        return self.report
+
+    def import_sheet(self, title, rows):
+        rows = iter(rows)
+        try:
+            header = [cell_text(value) for value in next(rows)]
+        except StopIteration:
+            header = []
+        if self.identifier not in header:
+            self.report.skipped_sheets.append(title)
+            return
+
+        identifier_index = header.index(self.identifier)
+        identifiers = getattr(self.model, 'survey_identifiers', [])
+        columns = []
+        for index, code in enumerate(header):
+            if code in self.fields:
+                columns.append((index, self.fields[code]))
+            elif code and code != self.identifier and code not in identifiers:
+                self.report.add_error(title, 1, code, 'Unknown code')
+
+        # {identifier: (first row number, {desired_fact_id: (df, data)})}
+        batch, batch_facts = {}, 0
+        for row_number, row in enumerate(rows, 2):
+            self.report.rows += 1
+            row = [cell_text(value) for value in row]
+            row += [u''] * (len(header) - len(row))
+            key = row[identifier_index]
+            if not key:
+                self.report.add_error(title, row_number, self.identifier,
+                        'No subject identifier')
+                continue
+            if key not in batch:
+                # rows for one subject are kept in the same batch, so that
+                # MULTI values spread over several rows are combined
+                if batch_facts >= self.batch_size:
+                    self._write_batch(title, batch)
+                    batch, batch_facts = {}, 0
+                batch[key] = (row_number, {})
+            fact_data = batch[key][1]
+            for index, field in columns:
+                data = self._clean(title, row_number, field, row[index])
+                if data is None:
+                    continue
+                desired_fact = field.desired_fact
+                if desired_fact.data_type == models.MULTI and \
+                        desired_fact.id in fact_data:
+                    data = fact_data[desired_fact.id][1] + data
+                fact_data[desired_fact.id] = (desired_fact, data)
+                batch_facts += 1
+        if batch:
+            self._write_batch(title, batch)
+
+    def _clean(self, title, row_number, field, value):
+        """Return the value prepared for saving, or None if it is blank or
+        invalid.
+        """
+        if not value:
+            return None
+        codes = self.option_codes.get(field.desired_fact.code, {})
+        if field.desired_fact.data_type == models.MULTI:
+            value = [v.strip() for v in value.split(',') if v.strip()]
+            value = [codes.get(v, v) for v in value]
+        else:
+            value = codes.get(value, value)
+        try:
+            return field.prep_data_for_saving(field.clean(value))
+        except ValidationError as e:
+            self.report.add_error(title, row_number, field.desired_fact.code,
+                    '; '.join(e.messages))
+            return None
+
+    def _write_batch(self, title, batch):
+        pks = {}
+        for keys in models.batches(batch.keys()):
+            subjects = self.model.objects\
+                    .filter(**{self.identifier + '__in': keys})\
+                    .values_list(self.identifier, 'pk')
+            pks.update((unicode(key), pk) for key, pk in subjects)
+
+        fact_data_by_subject = {}
+        for key, (row_number, fact_data) in batch.iteritems():
+            if key not in pks:
+                self.report.add_error(title, row_number, self.identifier,
+                        'Unknown subject %s' % key)
+            elif fact_data:
+                fact_data_by_subject[pks[key]] = fact_data.values()
+
+        created, updated, deleted = models.Fact.bulk_create_or_update_subjects(
+                self.survey, self.content_type, fact_data_by_subject,
+                self.user)
+        self.report.created += created
+        self.report.updated += updated
+        self.report.deleted += deleted
@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.importer import FactImporter
+from survey.models import Survey
+
+
+class Command(BaseCommand):
+    args = '<survey_id> <app_label.model> <path>'
+    help = ('Import facts for subjects of one content type from an .xlsx, '
+            '.csv or .tsv file laid out like a survey export.')
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='username',
+            help='Username to record as creating the facts.'),
+        make_option('--identifier',
+            help='Column identifying subjects. Defaults to the first of '
+                 'the model\'s survey_identifiers, or id.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError('Usage: %s' % self.args)
+        survey_id, natural_key, path = args
+        try:
+            survey = Survey.objects.get(pk=survey_id)
+            content_type = ContentType.objects.get_by_natural_key(
+                    *natural_key.split('.', 1))
+            user = User.objects.get(username=options['username'])
+        except (Survey.DoesNotExist, ContentType.DoesNotExist,
+                User.DoesNotExist, TypeError) as e:
+            raise CommandError(e)
+
+        importer = FactImporter(survey, content_type, user,
+                identifier=options['identifier'])
+        if path.endswith('.xlsx'):
+            report = importer.import_workbook(path)
+        else:
+            delimiter = '\t' if path.endswith('.tsv') else ','
+            with open(path, 'rb') as csv_file:
+                report = importer.import_csv(csv_file, delimiter=delimiter)
+
+        for sheet, row_number, code, message in report.errors:
+            self.stderr.write('%s row %d, %s: %s\n' %
+                    (sheet or path, row_number, code, message))
+        self.stdout.write('%d rows: %d facts created, %d updated, %d deleted, '
+                '%d errors\n' % (report.rows, report.created, report.updated,
+                    report.deleted, len(report.errors)))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.models import Survey, rebuild_progress
+
+
+class Command(BaseCommand):
+    args = '<survey_id survey_id ...>'
+    help = 'Recalculate progress counters for the given surveys, or all surveys.'
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if args:
+            surveys = surveys.filter(pk__in=args)
+            if len(surveys) != len(args):
+                raise CommandError('Unknown survey id in %s' % ', '.join(args))
+
+        for survey in surveys:
+            rebuild_progress(survey)
+            self.stdout.write('Rebuilt progress for %s\n' % survey)
@@ -0,0 +1,39 @@
+import time
+from optparse import make_option
+
+from django import db
+from django.core.management.base import BaseCommand
+
+from survey.export import run_export_job
+from survey.models import ExportJob, EXPORT_JOB_STALE_AFTER
+
+
+class Command(BaseCommand):
+    help = 'Run pending export jobs, polling the database for new ones.'
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=5.0,
+            help='Seconds to wait between polls when there are no jobs.'),
+        make_option('--once', action='store_true', default=False,
+            help='Run the pending jobs, then exit.'),
+        make_option('--stale-after', type='float',
+            default=EXPORT_JOB_STALE_AFTER,
+            help='Seconds after which a running job that has reported no '
+                 'progress is marked as failed.'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            stale = ExportJob.fail_stale(options['stale_after'])
+            if stale:
+                self.stdout.write('Marked %d stale jobs as failed\n' % stale)
+            job = ExportJob.claim_next()
+            if job is not None:
+                self.stdout.write('Running %s\n' % job)
+                run_export_job(job)
+                self.stdout.write('%s: %s\n' % (job, job.get_status_display()))
+                continue
+            if options['once']:
+                return
+            # don't hold a connection, or a stale snapshot, while idle
+            db.close_connection()
+            time.sleep(options['interval'])
@@ -1,9 +1,21 @@
-from django.db import models
+import math
+import time
+from datetime import timedelta
+from collections import OrderedDict, defaultdict
+from threading import Lock, local
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.auth.models import User
 from django.core.exceptions import MultipleObjectsReturned
 from django.utils.datastructures import MultiValueDict
+from django.utils import timezone
 
 YES_CODE, NO_CODE = 1, 2
 TEXT, SELECT, INT, FLOAT, YES_NO, MULTI = 'T', 'S', 'I', 'F', 'Y', 'M'
@@ -15,6 +27,124 @@ DATA_TYPES = (
     (SELECT, 'Selection from a list'),
     (MULTI, 'Multiple selections from a list'),
 )
+CHOICE_TYPES = (SELECT, MULTI, YES_NO)
+
+def numeric_value(data_type, data):
+    """The value to store in Fact.numeric_data for data of this type. None
+    for non-numeric types and for data that is blank, can't be parsed or
+    isn't finite.
+    """
+    if data_type not in (INT, FLOAT, YES_NO) or not data:
+        return None
+    try:
+        value = float(data)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    if data_type == YES_NO:
+        return 1.0 if int(value) == YES_CODE else 0.0
+    return value
+
+def recompute_numeric_data(desired_fact_id, data_type):
+    """Set numeric_data for all of the desired fact's facts as for data of
+    data_type, e.g. after the desired fact's data type changes.
+    """
+    facts = Fact.objects.filter(desired_fact=desired_fact_id)
+    if data_type not in (INT, FLOAT, YES_NO):
+        facts.update(numeric_data=None)
+        return
+    # far fewer distinct values than facts, so update by value
+    values = facts.order_by().values_list('data', flat=True).distinct()
+    for data in list(values):
+        facts.filter(data=data).update(
+                numeric_data=numeric_value(data_type, data))
+
+
+def make_choices(data_type, fact_options):
+    """Return choices for a desired fact of this data type with these
+    options, as DesiredFact.choices does.
+    """
+    if data_type == YES_NO:
+        cs = [(YES_CODE, '%s-Yes' % YES_CODE), (NO_CODE, '%s-No' % NO_CODE)]
+    else:
+        cs = [(fo.code, "%s-%s" % (fo.code.lstrip('0'), fo.description))
+            for fo in fact_options]
+    cs.insert(0, ('', 'Make a selection'))
+    return cs
+
+def batches(items, batch_size=500):
+    """Split the list items into lists of at most batch_size, e.g. to keep
+    the parameters of an __in lookup within the database's limits.
+    """
+    return [items[i:i + batch_size]
+            for i in range(0, len(items), batch_size)]
+
+def options_by_desired_fact(desired_fact_ids, batch_size=500):
+    """Return {desired_fact_id: [option, ...], ...} with options ordered by
+    code, using one query per batch_size desired facts.
+    """
+    options = defaultdict(list)
+    for ids in batches(list(desired_fact_ids), batch_size):
+        batch = FactOption.objects.filter(desired_fact__in=ids)\
+                .order_by('code')
+        for fo in batch:
+            options[fo.desired_fact_id].append(fo)
+    return options
+
+def choices_by_desired_fact(desired_facts):
+    """Return {desired_fact_id: choices, ...} for those of desired_facts
+    that have choices, loading all their options at once rather than with
+    one query each.
+    """
+    choice_dfs = [df for df in desired_facts if df.data_type in CHOICE_TYPES]
+    options = options_by_desired_fact(
+            df.id for df in choice_dfs if df.data_type != YES_NO)
+    return dict((df.id, make_choices(df.data_type, options[df.id]))
+            for df in choice_dfs)
+
+def typed_value(data_type, data):
+    """Convert data to the python type for a desired fact of data_type.
+    Options for SELECT and MULTI data must be looked up by the caller.
+    """
+    if data_type == TEXT:
+        return data
+    if data_type == INT:
+        return int(data or 0)
+    if data_type == FLOAT:
+        return float(data or 0)
+    if data_type == YES_NO:
+        return int(data) == YES_CODE
+    raise ValueError("Invalid data_type %s" % data_type)
+
+def typed_data_for_facts(facts):
+    """Return a list of (fact, typed_data) pairs for the facts, with the
+    same values as Fact.typed_data. Desired facts are loaded in one query
+    and options in one lookup table per desired fact, rather than with
+    queries for every fact.
+    """
+    facts = list(facts)
+    desired_facts = DesiredFact.objects\
+            .in_bulk(set(fact.desired_fact_id for fact in facts))
+    option_lists = options_by_desired_fact(df.id
+            for df in desired_facts.values() if df.data_type in (SELECT, MULTI))
+    options = dict((df_id, dict((fo.code, fo) for fo in fos))
+            for df_id, fos in option_lists.items())
+
+    typed_data = []
+    for fact in facts:
+        data_type = desired_facts[fact.desired_fact_id].data_type
+        if data_type in (SELECT, MULTI):
+            try:
+                value = options[fact.desired_fact_id][fact.data]
+            except KeyError:
+                raise FactOption.DoesNotExist("No option %s for %s" %
+                        (fact.data, desired_facts[fact.desired_fact_id]))
+        else:
+            value = typed_value(data_type, fact.data)
+        typed_data.append((fact, value))
+    return typed_data
+
 
 class Project(models.Model):
     """A project is an organizing category for multiple surveys.
@@ -97,13 +227,13 @@ class DesiredFact(models.Model):
         """Return a list of code, description tuples for choices. Format the
         description to make selection from drop-downs easier.
         """
+        choices = cached_choices(self.id)
+        if choices is not None:
+            return list(choices)
         if self.data_type == YES_NO:
-            cs = [(YES_CODE, '%s-Yes' % YES_CODE), (NO_CODE, '%s-No' % NO_CODE)]
-        else:
-            cs = [(fo.code, "%s-%s" % (fo.code.lstrip('0'), fo.description))
-                for fo in self.factoption_set.all().order_by('code')]
-        cs.insert(0, ('', 'Make a selection'))
-        return cs
+            return make_choices(self.data_type, [])
+        return make_choices(self.data_type,
+                self.factoption_set.all().order_by('code'))
 
     def __unicode__(self):
         return self.label
@@ -144,6 +274,10 @@ class SurveyDesiredFact(models.Model):
 
     weight = models.FloatField(default=1)
 
+    # number of facts gathered for this desired fact in the survey, kept up
+    # to date as facts are written
+    facts_collected = models.IntegerField(default=0)
+
     class Meta:
         # a desired fact can only appear once in each survey
         unique_together = ('survey', 'desired_fact')
@@ -153,6 +287,25 @@ class SurveyDesiredFact(models.Model):
                 desired_fact=self.desired_fact, fact_group=self.fact_group)
 
 
+class SurveyProgress(models.Model):
+    """Counts of the subjects of one content type for which a survey has
+    gathered any facts, and all required facts. Kept up to date as facts
+    are written, so progress can be shown without counting facts.
+    """
+    survey = models.ForeignKey(Survey)
+    content_type = models.ForeignKey(ContentType)
+    subjects_started = models.IntegerField(default=0)
+    subjects_completed = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('survey', 'content_type')
+
+    def __unicode__(self):
+        return "{survey} > {content_type}: {completed}/{started}".format(
+                survey=self.survey, content_type=self.content_type,
+                completed=self.subjects_completed, started=self.subjects_started)
+
+
 class Fact(models.Model):
     """A single piece of information gathered for one subject, in the course of
     a survey, and related to one desired fact.
@@ -162,11 +315,13 @@ class Fact(models.Model):
     data. However this generally makes things harder to query and reason about.
 
     Munging all data into text and storing it here is not particularly pretty,
-    but it works.
+    but it works. For numeric desired facts the data is also stored as a
+    number in numeric_data, so that range queries can use an index.
     """
     survey = models.ForeignKey(Survey)
     desired_fact = models.ForeignKey(DesiredFact)
     data = models.CharField(max_length=1024)
+    numeric_data = models.FloatField(blank=True, null=True)
 
     content_type = models.ForeignKey(ContentType)
     object_id = models.PositiveIntegerField()
@@ -178,66 +333,151 @@ class Fact(models.Model):
     updated_by = models.ForeignKey(User, related_name='updated_by')
     updated_on = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # match the filters used to look up facts for a subject, and to
+        # match subjects by value; data is too long to index on MySQL, so
+        # lookups by value use the (survey, desired_fact) prefix of the
+        # numeric_data index
+        index_together = [
+            ('survey', 'content_type', 'object_id', 'desired_fact'),
+            ('survey', 'desired_fact', 'numeric_data'),
+            ('survey', 'content_type', 'updated_on'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super(Fact, self).__init__(*args, **kwargs)
+        # what numeric_data was last computed from, so that save only
+        # needs the desired fact's data type when it may have changed
+        self._numeric_source = (self.desired_fact_id, self.data) \
+                if self.pk else None
+
+    def save(self, *args, **kwargs):
+        if self._numeric_source != (self.desired_fact_id, self.data):
+            # uses the desired fact instance the fact was created with, if
+            # any, rather than fetching it
+            self.numeric_data = numeric_value(self.desired_fact.data_type,
+                    self.data)
+        super(Fact, self).save(*args, **kwargs)
+        self._numeric_source = (self.desired_fact_id, self.data)
+
     @property
     def typed_data(self):
         _type = self.desired_fact.data_type
-        if _type == TEXT:
-            return self.data
-        if _type == INT:
-            return int(self.data or 0)
-        if _type == FLOAT:
-            return float(self.data or 0)
-        if _type == YES_NO:
-            return int(self.data) == YES_CODE
         if _type in (SELECT, MULTI):
             return FactOption.objects\
                     .get(desired_fact=self.desired_fact, code=self.data)
-
-        raise ValueError("Desired fact %s has invalid data_type" % self)
+        return typed_value(_type, self.data)
 
     @staticmethod
     def create_or_update(survey, desired_fact, content_type, object_id, data,
                          user):
+        """Set the subject's data for one desired fact, which may be a
+        DesiredFact or a SchemaDesiredFact, as form fields have. A list or
+        tuple of data is only accepted for MULTI desired facts, and None
+        leaves the facts as they are.
+
+        Only the subject's facts for this desired fact are loaded. Which
+        other desired facts it has facts for is only queried when whether it
+        has any for this one changes, as that's when progress can change.
+        """
+        _check_fact_data(desired_fact, data)
         if data is None:
             return
-        elif isinstance(data, (list, tuple)):
-            if desired_fact.data_type != MULTI:
-                raise ValueError('Multiple fact instances for non-multi desired fact')
-            current_data = Fact.objects.filter(survey=survey,
-                    desired_fact=desired_fact, object_id=object_id,
-                    content_type=content_type)\
-                    .values_list('data', flat=True)
-            current_data = set(current_data)
-            incoming_data = set(data)
-            for data_to_add in incoming_data - current_data:
-                Fact.objects.create(survey=survey, data=data_to_add,
-                        desired_fact=desired_fact, object_id=object_id,
-                        content_type=content_type, created_by=user,
-                        updated_by=user)
-            for data_to_del in current_data - incoming_data:
-                Fact.objects.filter(survey=survey, data=data_to_del,
-                        desired_fact=desired_fact, object_id=object_id,
-                        content_type=content_type).delete()
-        else:
-            try:
-                fact, created = Fact.objects.get_or_create(survey=survey,
-                        content_type=content_type, object_id=object_id,
-                        desired_fact=desired_fact, defaults={'data': data,
-                                                             'created_by': user,
-                                                             'updated_by': user})
-            except MultipleObjectsReturned:
-                # delete all but the most recently created fact
-                facts = list(Fact.objects.filter(survey=survey,
-                        content_type=content_type, object_id=object_id,
-                        desired_fact=desired_fact).order_by('created_on'))
-                for fact in facts[:-1]:
-                    fact.delete()
-                fact, created = facts[-1], False
-
-            if not created and fact.data != data:
-                fact.data = data
-                fact.updated_by = user
-                fact.save()
+        current_facts = list(Fact.objects.filter(survey=survey,
+                content_type=content_type, object_id=object_id,
+                desired_fact=desired_fact.id).order_by('created_on', 'id'))
+        created, deleted, updated = _fact_changes(desired_fact,
+                current_facts, data)
+        if not (created or deleted or updated):
+            return
+
+        delta = len(created) - len(deleted)
+        present_before = set()
+        if bool(current_facts) != bool(len(current_facts) + delta):
+            present_before.update(Fact.objects.filter(survey=survey,
+                    content_type=content_type, object_id=object_id)\
+                    .exclude(desired_fact=desired_fact.id)\
+                    .values_list('desired_fact_id', flat=True).distinct())
+        if current_facts:
+            present_before.add(desired_fact.id)
+
+        to_update = {(desired_fact.data_type, data): updated} if updated \
+                else {}
+        with transaction.commit_on_success():
+            _write_facts(survey, content_type, user,
+                    [(object_id, desired_fact, d) for d in created],
+                    to_update, deleted)
+            _update_progress(survey, content_type,
+                    [({desired_fact.id: current_facts}, present_before,
+                      {desired_fact.id: delta})])
+
+    @staticmethod
+    def bulk_create_or_update(survey, content_type, object_id, fact_data,
+                              user):
+        """Apply create_or_update to many desired facts for one subject at
+        once. fact_data is a list of (desired_fact, data) pairs, with data
+        as create_or_update accepts it.
+
+        Existing facts are loaded with one query, and the resulting
+        inserts, updates and deletes are made with bulk queries in a single
+        transaction.
+        """
+        Fact.bulk_create_or_update_subjects(survey, content_type,
+                {object_id: fact_data}, user)
+
+    @staticmethod
+    def bulk_create_or_update_subjects(survey, content_type,
+                                       fact_data_by_subject, user):
+        """Apply bulk_create_or_update to many subjects of one content type
+        at once. fact_data_by_subject maps object ids to fact_data lists.
+
+        The number of queries depends on the number of subjects only through
+        batching, so thousands of subjects can be written at a time. Return
+        the numbers of facts (created, updated, deleted).
+        """
+        for fact_data in fact_data_by_subject.itervalues():
+            for desired_fact, data in fact_data:
+                _check_fact_data(desired_fact, data)
+
+        existing_by_subject = defaultdict(lambda: defaultdict(list))
+        for object_ids in batches(list(fact_data_by_subject)):
+            facts = Fact.objects.filter(survey=survey,
+                    content_type=content_type, object_id__in=object_ids)\
+                    .order_by('created_on', 'id')
+            for fact in facts:
+                existing_by_subject[fact.object_id][fact.desired_fact_id]\
+                        .append(fact)
+
+        to_create, to_delete = [], []
+        # updates are grouped by new data, so each group is one query
+        to_update = defaultdict(list)
+        # (existing, present_before, fact_deltas) for each subject
+        subjects = []
+        for object_id, fact_data in fact_data_by_subject.iteritems():
+            existing = existing_by_subject[object_id]
+            present_before = set(df_id for df_id, facts in existing.items()
+                    if facts)
+            fact_deltas = defaultdict(int)
+            for desired_fact, data in fact_data:
+                if data is None:
+                    continue
+                created, deleted, updated = _fact_changes(desired_fact,
+                        existing[desired_fact.id], data)
+                to_create.extend((object_id, desired_fact, data_to_add)
+                        for data_to_add in created)
+                to_delete.extend(deleted)
+                if updated:
+                    to_update[(desired_fact.data_type, data)].extend(updated)
+                fact_deltas[desired_fact.id] += len(created) - len(deleted)
+            subjects.append((existing, present_before, fact_deltas))
+
+        with transaction.commit_on_success():
+            _write_facts(survey, content_type, user, to_create, to_update,
+                    to_delete)
+            _update_progress(survey, content_type, subjects)
+
+        updated = sum(len(facts) for facts in to_update.values())
+        return len(to_create), updated, len(to_delete)
 
     @staticmethod
     def existing_facts(survey, subject, prefix=None):
@@ -262,17 +502,581 @@ class Fact(models.Model):
                 desired_fact=self.desired_fact, subject=self.subject)
 
 
+def _check_fact_data(desired_fact, data):
+    if isinstance(data, (list, tuple)) and desired_fact.data_type != MULTI:
+        raise ValueError('Multiple fact instances for non-multi desired fact')
+
+def _fact_changes(desired_fact, current_facts, data):
+    """Return the data of the facts to create, and the facts to delete and
+    to update, to set data for a subject with current_facts for the
+    desired fact.
+    """
+    if isinstance(data, (list, tuple)):
+        current_data = set(fact.data for fact in current_facts)
+        incoming_data = set(data)
+        return (list(incoming_data - current_data),
+                [fact for fact in current_facts
+                    if fact.data not in incoming_data],
+                [])
+    if not current_facts:
+        return [data], [], []
+    # delete all but the most recently created fact
+    fact = current_facts[-1]
+    return [], current_facts[:-1], [fact] if fact.data != data else []
+
+def _write_facts(survey, content_type, user, to_create, to_update, to_delete):
+    """Make the changes worked out by _fact_changes: to_create is a list of
+    (object_id, desired_fact, data), and to_update maps (data type, data)
+    to the facts that get that data, so each is one query per batch.
+    """
+    if to_delete:
+        FactTombstone.objects.bulk_create([FactTombstone(
+                survey=survey, desired_fact_id=fact.desired_fact_id,
+                content_type=content_type, object_id=fact.object_id,
+                data=fact.data) for fact in to_delete])
+        for pks in batches([fact.pk for fact in to_delete]):
+            Fact.objects.filter(pk__in=pks).delete()
+    now = timezone.now()
+    for (data_type, data), facts in to_update.items():
+        for pks in batches([fact.pk for fact in facts]):
+            Fact.objects.filter(pk__in=pks)\
+                    .update(data=data, updated_by=user, updated_on=now,
+                            numeric_data=numeric_value(data_type, data))
+    if to_create:
+        Fact.objects.bulk_create([Fact(survey=survey, data=data,
+                desired_fact_id=desired_fact.id, object_id=object_id,
+                content_type=content_type, created_by=user, updated_by=user,
+                numeric_data=numeric_value(desired_fact.data_type, data))
+            for object_id, desired_fact, data in to_create])
+
+
+class FactTombstone(models.Model):
+    """Records a fact deleted by Fact.create_or_update or
+    bulk_create_or_update, so that delta exports can tell which subjects
+    changed through deletions.
+    """
+    survey = models.ForeignKey(Survey)
+    desired_fact = models.ForeignKey(DesiredFact)
+    data = models.CharField(max_length=1024)
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    deleted_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [
+            ('survey', 'content_type', 'deleted_on'),
+        ]
+
+
+class ExportManifest(models.Model):
+    """Records an export of a survey's data, for all content types or, for
+    CSV and TSV exports, just content_type. Facts changed after the
+    watermark weren't necessarily included, so the next delta export should
+    include subjects changed since then.
+    """
+    survey = models.ForeignKey(Survey)
+    content_type = models.ForeignKey(ContentType, blank=True, null=True)
+    filename = models.CharField(max_length=255)
+    # the watermark of the export this one was a delta from, if any
+    since = models.DateTimeField(blank=True, null=True)
+    watermark = models.DateTimeField()
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.filename
+
+
+XLSX, CSV, TSV = 'xlsx', 'csv', 'tsv'
+EXPORT_JOB_FORMATS = (
+    (XLSX, 'Excel workbook'),
+    (CSV, 'Comma separated values'),
+    (TSV, 'Tab separated values'),
+)
+PENDING, RUNNING, DONE, FAILED = 'P', 'R', 'D', 'F'
+EXPORT_JOB_STATUSES = (
+    (PENDING, 'Pending'),
+    (RUNNING, 'Running'),
+    (DONE, 'Done'),
+    (FAILED, 'Failed'),
+)
+# seconds a running job can go without reporting progress before its
+# worker is taken to have died
+EXPORT_JOB_STALE_AFTER = getattr(settings, 'SURVEY_EXPORT_JOB_STALE_AFTER',
+        60 * 60)
+
+class ExportJob(models.Model):
+    """An export waiting for, or being run by, the run_export_worker
+    management command. Excel exports cover the whole survey, CSV and TSV
+    exports the one content type.
+
+    Progress is counted in subject rows: rows_total is the number of
+    subjects to export, summed over content types, and rows_done the
+    number exported so far. heartbeat_on is updated whenever progress is
+    reported, so that jobs whose worker died can be found.
+    """
+    survey = models.ForeignKey(Survey)
+    content_type = models.ForeignKey(ContentType, blank=True, null=True)
+    format = models.CharField(max_length=4, choices=EXPORT_JOB_FORMATS,
+            default=XLSX)
+    since = models.DateTimeField(blank=True, null=True)
+
+    status = models.CharField(max_length=1, choices=EXPORT_JOB_STATUSES,
+            default=PENDING)
+    rows_done = models.IntegerField(default=0)
+    rows_total = models.IntegerField(blank=True, null=True)
+    filename = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+
+    created_by = models.ForeignKey(User)
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(blank=True, null=True)
+    finished_on = models.DateTimeField(blank=True, null=True)
+    heartbeat_on = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        index_together = [
+            ('status', 'created_on'),
+        ]
+
+    def __unicode__(self):
+        return u'%s export of %s' % (self.format, self.survey)
+
+    @staticmethod
+    def claim_next():
+        """Mark the oldest pending job as running and return it, or return
+        None if there are no pending jobs. The status is changed with a
+        conditional update, so concurrent workers never claim the same job.
+        """
+        while True:
+            pending = ExportJob.objects.filter(status=PENDING)\
+                    .order_by('created_on', 'id')\
+                    .values_list('pk', flat=True)[:1]
+            if not pending:
+                return None
+            now = timezone.now()
+            claimed = ExportJob.objects.filter(pk=pending[0], status=PENDING)\
+                    .update(status=RUNNING, started_on=now, heartbeat_on=now)
+            if claimed:
+                return ExportJob.objects.get(pk=pending[0])
+
+    @staticmethod
+    def fail_stale(stale_after=EXPORT_JOB_STALE_AFTER):
+        """Mark running jobs that haven't reported progress for stale_after
+        seconds as failed, as their worker has presumably died, and return
+        how many there were.
+        """
+        now = timezone.now()
+        return ExportJob.objects.filter(status=RUNNING,
+                heartbeat_on__lt=now - timedelta(seconds=stale_after))\
+                .update(status=FAILED, finished_on=now,
+                        error='The export stopped responding.')
+
+    def output_filename(self):
+        return 'export_job_%d.%s' % (self.pk, self.format)
+
+    def _set(self, **fields):
+        # update only these fields, as rows_done is counted in the database
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+        ExportJob.objects.filter(pk=self.pk).update(**fields)
+
+    def start(self, rows_total):
+        self._set(rows_total=rows_total, rows_done=0,
+                heartbeat_on=timezone.now())
+
+    def add_progress(self, rows):
+        """Count rows more rows as done. Safe to call from export worker
+        processes, as the counter is incremented in the database.
+        """
+        ExportJob.objects.filter(pk=self.pk)\
+                .update(rows_done=models.F('rows_done') + rows,
+                        heartbeat_on=timezone.now())
+
+    def finish(self, filename):
+        self._set(status=DONE, filename=filename, rows_done=self.rows_total,
+                finished_on=timezone.now())
+
+    def fail(self, error):
+        self._set(status=FAILED, error=error, finished_on=timezone.now())
+
+
 def has_required_data(survey, subject):
     """True if this subject has facts present for all required
     facts in the supplied survey. Otherwise False.
     """
     content_type = ContentType.objects.get_for_model(subject)
-    required_ids = DesiredFact.objects\
-            .filter(surveys=survey, required=True, content_type=content_type)\
-            .values_list('id', flat=True)
+    required_ids = survey_schema(survey).for_content_type(content_type)\
+            .required_ids
+    if not required_ids:
+        return True
     present_ids = Fact.objects.filter(survey=survey,
             content_type=content_type, object_id=subject.id)\
             .values_list('desired_fact_id', flat=True)
-    return not set(required_ids).difference(set(present_ids))
+    return not required_ids.difference(present_ids)
+
+
+def _subject_progress(present_ids, required_ids):
+    """(started, completed) for a subject with facts for present_ids."""
+    started = bool(present_ids)
+    return started, started and required_ids <= present_ids
+
+def _update_progress(survey, content_type, subjects):
+    """Apply the changes in fact counts for subjects of one content type to
+    the survey's progress counters. subjects is a list of (existing,
+    present_before, fact_deltas) for each subject, where existing maps
+    desired fact ids to the subject's facts before the change, and
+    fact_deltas to the change in their number.
+    """
+    total_deltas = defaultdict(int)
+    changed = []
+    for existing, present_before, fact_deltas in subjects:
+        fact_deltas = dict((df_id, delta)
+                for df_id, delta in fact_deltas.items() if delta)
+        if fact_deltas:
+            changed.append((existing, present_before, fact_deltas))
+        for df_id, delta in fact_deltas.items():
+            total_deltas[df_id] += delta
+    if not changed:
+        return
+
+    dfs_by_delta = defaultdict(list)
+    for df_id, delta in total_deltas.items():
+        if delta:
+            dfs_by_delta[delta].append(df_id)
+    for delta, df_ids in dfs_by_delta.items():
+        SurveyDesiredFact.objects\
+                .filter(survey=survey, desired_fact__in=df_ids)\
+                .update(facts_collected=models.F('facts_collected') + delta)
+
+    required_ids = set(DesiredFact.objects
+            .filter(surveys=survey, required=True, content_type=content_type)
+            .values_list('id', flat=True))
+    started, completed = 0, 0
+    for existing, present_before, fact_deltas in changed:
+        present_after = set(present_before)
+        for df_id, delta in fact_deltas.items():
+            if len(existing[df_id]) + delta > 0:
+                present_after.add(df_id)
+            else:
+                present_after.discard(df_id)
+
+        started_before, completed_before = _subject_progress(present_before,
+                required_ids)
+        started_after, completed_after = _subject_progress(present_after,
+                required_ids)
+        started += started_after - started_before
+        completed += completed_after - completed_before
+    if not started and not completed:
+        return
+
+    progress, _ = SurveyProgress.objects.get_or_create(survey=survey,
+            content_type=content_type)
+    SurveyProgress.objects.filter(pk=progress.pk).update(
+            subjects_started=models.F('subjects_started') + started,
+            subjects_completed=models.F('subjects_completed') + completed)
+
+def rebuild_progress(survey):
+    """Recalculate all of the survey's progress counters from its facts.
+    Needed after facts are written other than through create_or_update
+    and bulk_create_or_update, or after required desired facts change.
+    """
+    with transaction.commit_on_success():
+        facts = Fact.objects.filter(survey=survey)
+        counts = dict(facts.order_by().values_list('desired_fact')\
+                .annotate(models.Count('id')))
+        for sdf in SurveyDesiredFact.objects.filter(survey=survey):
+            collected = counts.get(sdf.desired_fact_id, 0)
+            if sdf.facts_collected != collected:
+                SurveyDesiredFact.objects.filter(pk=sdf.pk)\
+                        .update(facts_collected=collected)
+
+        SurveyProgress.objects.filter(survey=survey).delete()
+        content_type_ids = facts.order_by()\
+                .values_list('content_type', flat=True).distinct()
+        for content_type_id in list(content_type_ids):
+            content_type = ContentType.objects.get_for_id(content_type_id)
+            required_ids = set(DesiredFact.objects
+                    .filter(surveys=survey, required=True,
+                            content_type=content_type)
+                    .values_list('id', flat=True))
+
+            present = defaultdict(set)
+            pairs = facts.filter(content_type=content_type).order_by()\
+                    .values_list('object_id', 'desired_fact_id').distinct()
+            for object_id, desired_fact_id in pairs.iterator():
+                present[object_id].add(desired_fact_id)
+
+            completed = sum(1 for present_ids in present.values()
+                    if _subject_progress(present_ids, required_ids)[1])
+            SurveyProgress.objects.create(survey=survey,
+                    content_type=content_type, subjects_started=len(present),
+                    subjects_completed=completed)
+
+def incomplete_subject_pks(survey, content_type):
+    """Return, in order, the pks of subjects of this content type that have
+    facts in the survey, but not for all its required desired facts.
+
+    The facts are queried rather than trusting the progress counters, which
+    may be stale, but only subject ids are fetched, with two queries.
+    """
+    required_ids = survey_schema(survey).for_content_type(content_type)\
+            .required_ids
+    if not required_ids:
+        return []
+
+    facts = Fact.objects.filter(survey=survey, content_type=content_type)\
+            .order_by()
+    started = set(facts.values_list('object_id', flat=True).distinct())
+    complete = facts.filter(desired_fact__in=required_ids)\
+            .values('object_id')\
+            .annotate(present=models.Count('desired_fact', distinct=True))\
+            .filter(present=len(required_ids))
+    return sorted(started - set(row['object_id'] for row in complete))
+
+def missing_required_data(survey, subjects_qs):
+    """Return {subject_pk: [code, ...], ...} giving the codes of required
+    desired facts that have no facts yet, for every subject in subjects_qs
+    with any missing. Subjects are in primary key order.
+
+    Uses three queries however many subjects there are.
+    """
+    content_type = ContentType.objects.get_for_model(subjects_qs.model)
+    required = dict(DesiredFact.objects
+            .filter(surveys=survey, required=True, content_type=content_type)
+            .values_list('id', 'code'))
+    if not required:
+        return OrderedDict()
+
+    present = defaultdict(set)
+    present_pairs = Fact.objects.filter(survey=survey,
+            content_type=content_type, desired_fact__required=True,
+            object_id__in=subjects_qs.values('pk'))\
+            .values_list('object_id', 'desired_fact_id').distinct()
+    for object_id, desired_fact_id in present_pairs.iterator():
+        present[object_id].add(desired_fact_id)
 
+    required_ids = set(required)
+    missing = OrderedDict()
+    subject_pks = subjects_qs.order_by('pk').values_list('pk', flat=True)
+    for pk in subject_pks.iterator():
+        missing_ids = required_ids - present[pk]
+        if missing_ids:
+            missing[pk] = sorted(required[df_id] for df_id in missing_ids)
+    return missing
 
+SCHEMA_VERSION_KEY = 'survey_schema_version'
+# an explicit timeout, as None means the cache's default of a few minutes
+SCHEMA_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+# changes made in this process, so that they are seen here whatever the
+# cache backend
+_local_schema_changes = [0]
+_pending_schema_change = local()
+
+def schema_version():
+    """A value that changes whenever any survey's definition changes, i.e.
+    whenever desired facts, their options, groups or survey membership are
+    saved or deleted. Use it in cache keys for anything derived from
+    survey definitions.
+
+    It's kept in the django cache, so other processes only see changes if
+    they share a cache backend such as memcached. The default LocMemCache
+    is per process, so with it changes are only seen by the process that
+    made them. If the key expires or is evicted it restarts from the
+    current time, which is greater than any value it could have held.
+    """
+    cache.add(SCHEMA_VERSION_KEY, int(time.time() * 1000),
+            timeout=SCHEMA_VERSION_TIMEOUT)
+    return (cache.get(SCHEMA_VERSION_KEY), _local_schema_changes[0])
+
+@receiver(post_save, sender=SurveyDesiredFact)
+@receiver(post_delete, sender=SurveyDesiredFact)
+@receiver(post_save, sender=DesiredFact)
+@receiver(post_delete, sender=DesiredFact)
+@receiver(post_save, sender=FactOption)
+@receiver(post_delete, sender=FactOption)
+@receiver(post_save, sender=DesiredFactGroup)
+@receiver(post_delete, sender=DesiredFactGroup)
+def _increment_schema_version(sender, **kwargs):
+    increment_schema_version()
+    if transaction.is_managed():
+        # the change isn't committed yet, so another process could cache
+        # the old definition under the new version. Change it again once
+        # the request, and with it the transaction, has finished.
+        _pending_schema_change.pending = True
+
+@receiver(request_finished)
+def _increment_pending_schema_version(sender, **kwargs):
+    if getattr(_pending_schema_change, 'pending', False):
+        _pending_schema_change.pending = False
+        increment_schema_version()
+
+def increment_schema_version():
+    """Change the schema version, and drop this process's cached
+    SurveySchemas. Needed after survey definitions are changed with
+    bulk_create or update, which don't send signals, and should be called
+    after the transaction making the changes is committed.
+    """
+    with _schema_cache_lock:
+        _local_schema_changes[0] += 1
+        _schema_cache.clear()
+        _choices_cache.clear()
+    try:
+        cache.incr(SCHEMA_VERSION_KEY)
+    except ValueError:
+        cache.set(SCHEMA_VERSION_KEY, int(time.time() * 1000),
+                timeout=SCHEMA_VERSION_TIMEOUT)
+
+
+class _Frozen(object):
+    """Base for the compact, immutable parts of a SurveySchema."""
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+
+class SchemaDesiredFact(_Frozen):
+    """The parts of a DesiredFact that surveys use, with its choices. Can
+    be used in place of a DesiredFact by form fields and
+    Fact.bulk_create_or_update.
+    """
+    __slots__ = ('id', 'code', 'label', 'help_text', 'content_type_id',
+            'data_type', 'minimum', 'maximum', 'required', 'choices')
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __unicode__(self):
+        return self.label
+
+
+class SchemaGroup(_Frozen):
+    """A DesiredFactGroup with its desired facts for one content type, in
+    order of weight.
+    """
+    __slots__ = ('id', 'heading', 'weight', 'desired_facts')
+
+
+class ContentTypeSchema(_Frozen):
+    """A survey's desired facts for one content type. groups are in order
+    of weight, and desired_facts in the same order as the groups list
+    them. index maps codes to positions in desired_facts.
+    """
+    __slots__ = ('content_type_id', 'groups', 'desired_facts', 'by_code',
+            'index', 'required_ids')
+
+    @staticmethod
+    def build(content_type_id, groups):
+        desired_facts = tuple(df for group in groups
+                for df in group.desired_facts)
+        return ContentTypeSchema(content_type_id=content_type_id,
+                groups=tuple(groups), desired_facts=desired_facts,
+                by_code=dict((df.code, df) for df in desired_facts),
+                index=dict((df.code, i) for i, df in enumerate(desired_facts)),
+                required_ids=frozenset(df.id for df in desired_facts
+                    if df.required))
+
+
+class SurveySchema(_Frozen):
+    """A survey's definition, built with two queries and shared by the
+    forms, exports and queries that need it. Get one with survey_schema.
+
+    content_types maps content type ids to ContentTypeSchemas, in the order
+    their first groups appear, and desired_facts maps ids to
+    SchemaDesiredFacts.
+    """
+    __slots__ = ('survey_id', 'version', 'content_types', 'desired_facts')
+
+    def for_content_type(self, content_type):
+        content_type_id = getattr(content_type, 'pk', content_type)
+        schema = self.content_types.get(content_type_id)
+        if schema is None:
+            schema = ContentTypeSchema.build(content_type_id, ())
+        return schema
+
+    @staticmethod
+    def build(survey_id, version):
+        sdfs = list(SurveyDesiredFact.objects.filter(survey=survey_id)
+                .select_related('desired_fact', 'fact_group')
+                .order_by('fact_group__weight', 'fact_group__id', 'weight',
+                    'desired_fact__code'))
+        choices = choices_by_desired_fact(
+                [sdf.desired_fact for sdf in sdfs])
+
+        # {content_type_id: {group: [desired_fact, ...]}}, in order
+        groups_by_type = OrderedDict()
+        desired_facts = {}
+        for sdf in sdfs:
+            df = sdf.desired_fact
+            schema_df = SchemaDesiredFact(id=df.id, code=df.code,
+                    label=df.label, help_text=df.help_text,
+                    content_type_id=df.content_type_id,
+                    data_type=df.data_type, minimum=df.minimum,
+                    maximum=df.maximum, required=df.required,
+                    choices=tuple(choices[df.id]) if df.id in choices
+                        else None)
+            desired_facts[df.id] = schema_df
+            groups_by_type.setdefault(df.content_type_id, OrderedDict())\
+                    .setdefault(sdf.fact_group, []).append(schema_df)
+
+        content_types = OrderedDict()
+        for content_type_id, groups in groups_by_type.items():
+            content_types[content_type_id] = ContentTypeSchema.build(
+                    content_type_id, [SchemaGroup(id=group.id,
+                        heading=group.heading, weight=group.weight,
+                        desired_facts=tuple(dfs))
+                    for group, dfs in groups.items()])
+        return SurveySchema(survey_id=survey_id, version=version,
+                content_types=content_types, desired_facts=desired_facts)
+
+
+SCHEMA_CACHE_SIZE = getattr(settings, 'SURVEY_SCHEMA_CACHE_SIZE', 100)
+_schema_cache = OrderedDict()
+# {desired_fact_id: (version, choices)} from the schemas built, so that
+# choices can be found without searching every cached schema. Its size is
+# bounded by the number of desired facts with choices
+_choices_cache = {}
+_schema_cache_lock = Lock()
+
+def survey_schema(survey):
+    """Return the SurveySchema for a survey or survey id. Schemas are kept
+    in a process-local LRU cache, and rebuilt when the schema version
+    changes.
+    """
+    survey_id = getattr(survey, 'pk', survey)
+    version = schema_version()
+    with _schema_cache_lock:
+        schema = _schema_cache.pop(survey_id, None)
+        if schema is not None and schema.version == version:
+            _schema_cache[survey_id] = schema
+            return schema
+
+    schema = SurveySchema.build(survey_id, version)
+    with _schema_cache_lock:
+        _schema_cache[survey_id] = schema
+        for desired_fact in schema.desired_facts.itervalues():
+            if desired_fact.choices is not None:
+                _choices_cache[desired_fact.id] = (version,
+                        desired_fact.choices)
+        while len(_schema_cache) > SCHEMA_CACHE_SIZE:
+            _schema_cache.popitem(last=False)
+    return schema
+
+def cached_choices(desired_fact_id):
+    """Return a desired fact's choices from a cached SurveySchema of the
+    current version, or None if no such schema has them.
+    """
+    version = schema_version()
+    with _schema_cache_lock:
+        cached_version, choices = _choices_cache.get(desired_fact_id,
+                (None, None))
+    if cached_version != version:
+        return None
+    return choices
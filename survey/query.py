@@ -1,15 +1,31 @@
 from django.contrib.contenttypes.models import ContentType
-from survey.models import Fact
+from django.db import connections
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from survey.models import (Fact, FactOption, INT, FLOAT, YES_NO, YES_CODE,
+        NO_CODE, typed_data_for_facts)
 
-def _get_facts(survey, content_type=None, subjects_qs=None, desired_facts=None, value=None):
+SUM, AVG, MIN, MAX, COUNT = 'SUM', 'AVG', 'MIN', 'MAX', 'COUNT'
+
+# SQL types that fact data is cast to before aggregation, by database vendor
+CAST_TYPES = {
+    'mysql': {INT: 'SIGNED', FLOAT: 'DECIMAL(65, 30)'},
+    'default': {INT: 'INTEGER', FLOAT: 'DOUBLE PRECISION'},
+}
+NUMERIC_TYPES = (INT, FLOAT, YES_NO)
+# python types that the aggregate for each data type is returned as
+PYTHON_TYPES = {INT: int, FLOAT: float, YES_NO: int}
+
+def _get_facts(survey, content_type=None, subjects_qs=None, desired_facts=None,
+        value=None, gt=None, lt=None, between=None):
     # if content_type is specified, query for all subjects of that type
     if content_type:
         facts = Fact.objects.filter(survey=survey, content_type=content_type)
     elif subjects_qs is not None:
         content_type = ContentType.objects.get_for_model(subjects_qs.model)
-        object_ids = list(subjects_qs.values_list('pk', flat=True))
+        # a subquery, so the subject ids never leave the database
         facts = Fact.objects.filter(survey=survey, content_type=content_type,
-                object_id__in=object_ids)
+                object_id__in=subjects_qs.values('pk'))
     else:
         raise ValueError('Ambiguous arguments.')
 
@@ -21,13 +37,94 @@ def _get_facts(survey, content_type=None, subjects_qs=None, desired_facts=None,
     if value is not None:
         facts = facts.filter(data=value)
 
+    # range predicates use the typed numeric_data column
+    if gt is not None:
+        facts = facts.filter(numeric_data__gt=gt)
+    if lt is not None:
+        facts = facts.filter(numeric_data__lt=lt)
+    if between is not None:
+        facts = facts.filter(numeric_data__range=between)
+
     return facts
 
+def _numeric_expression(connection, data_type):
+    """SQL expression giving the numeric value of the data column for a fact
+    of the given data type, mirroring Fact.typed_data: blanks count as 0
+    and yes/no facts count as 1 for yes.
+    """
+    cast_types = CAST_TYPES.get(connection.vendor, CAST_TYPES['default'])
+    data = connection.ops.quote_name('data')
+    if data_type == YES_NO:
+        return "CASE WHEN CAST(NULLIF(%s, '') AS %s) = %d THEN 1 ELSE 0 END" %\
+                (data, cast_types[INT], YES_CODE)
+    return "CAST(COALESCE(NULLIF(%s, ''), '0') AS %s)" %\
+            (data, cast_types[data_type])
+
+def _aggregate(facts, function):
+    """Compute an aggregate over the typed data of facts in the database,
+    without loading the facts themselves.
+
+    Each numeric data type is aggregated in its own column, so that the
+    result has the same type as aggregating typed_data in python would.
+    Facts with non-numeric data types are only included in COUNT.
+    """
+    connection = connections[facts.db]
+    facts = facts.order_by().values_list('data', 'desired_fact__data_type')
+    try:
+        inner_sql, inner_params = facts.query\
+                .get_compiler(connection=connection).as_sql()
+    except EmptyResultSet:
+        return 0 if function in (SUM, COUNT) else None
+
+    if function == COUNT:
+        sql = "SELECT COUNT(*) FROM (%s) facts" % inner_sql
+        cursor = connection.cursor()
+        cursor.execute(sql, inner_params)
+        return cursor.fetchone()[0]
+
+    columns, params = [], []
+    data_type_col = connection.ops.quote_name('data_type')
+    for data_type in NUMERIC_TYPES:
+        expression = "CASE WHEN %s = %%s THEN %s END" %\
+                (data_type_col, _numeric_expression(connection, data_type))
+        if function == AVG:
+            columns.extend(["SUM(%s)" % expression, "COUNT(%s)" % expression])
+            params.extend([data_type, data_type])
+        else:
+            columns.append("%s(%s)" % (function, expression))
+            params.append(data_type)
+
+    sql = "SELECT %s FROM (%s) facts" % (', '.join(columns), inner_sql)
+    cursor = connection.cursor()
+    cursor.execute(sql, params + list(inner_params))
+    row = cursor.fetchone()
+
+    if function == AVG:
+        sums, counts = row[0::2], row[1::2]
+        total = sum(PYTHON_TYPES[data_type](value)
+                for data_type, value in zip(NUMERIC_TYPES, sums)
+                if value is not None)
+        count = sum(counts)
+        return float(total) / count if count else None
+
+    values = [PYTHON_TYPES[data_type](value)
+            for data_type, value in zip(NUMERIC_TYPES, row)
+            if value is not None]
+    if function == SUM:
+        return sum(values)
+    if not values:
+        return None
+    return min(values) if function == MIN else max(values)
+
 def _get_subject_ids_for_facts(facts):
-    return facts.distinct('object_id').values_list('object_id', flat=True)
+    """A queryset of the distinct subject ids for the facts, suitable for
+    use as a subquery.
+    """
+    return facts.order_by().values_list('object_id', flat=True).distinct()
 
 
-def get_subjects(survey, content_type, desired_facts=None, value=None):
+def get_subjects(survey, content_type, desired_facts=None, value=None,
+        gt=None, lt=None, between=None):
     """For a given survey, return all subjects of the specified type.
 
     If a desired fact is specified, only return those subjects that have
@@ -36,20 +133,133 @@ def get_subjects(survey, content_type, desired_facts=None, value=None):
     If a value is specified, only return subjects whose data matches the
     value.
 
-    Desired fact and value can be specified together.
+    For numeric desired facts, gt, lt and between (a (low, high) tuple,
+    inclusive) only return subjects whose data is in that range.
+
+    Desired fact and value or range can be specified together.
     """
     facts = _get_facts(survey, content_type=content_type, 
-            desired_facts=desired_facts, value=value)
+            desired_facts=desired_facts, value=value, gt=gt, lt=lt,
+            between=between)
     subject_ids = _get_subject_ids_for_facts(facts)
     return content_type.model_class().objects.filter(pk__in=subject_ids)
 
+class FactQ(object):
+    """A condition on the facts recorded about a subject, for the desired
+    fact with the given code. Takes the same value, gt, lt and between
+    arguments as get_subjects, or none to require that any fact is present.
+
+    Conditions combine with &, | and ~, like django's Q objects:
+
+        FactQ('tv', value='1') & FactQ('income', gt=5000) &
+            (FactQ('region', value='3') | FactQ('region', value='4'))
+
+    filter_subjects compiles the whole condition into a single query.
+    """
+    AND, OR = 'AND', 'OR'
+
+    def __init__(self, code=None, **lookups):
+        self.code, self.lookups = code, lookups
+        self.children, self.connector, self.negated = [], None, False
+
+    def _combine(self, other, connector):
+        combined = FactQ()
+        combined.children, combined.connector = [self, other], connector
+        return combined
+
+    def __and__(self, other):
+        return self._combine(other, self.AND)
+
+    def __or__(self, other):
+        return self._combine(other, self.OR)
+
+    def __invert__(self):
+        negated = FactQ()
+        negated.children, negated.negated = [self], True
+        return negated
+
+    def subject_q(self, survey, content_type):
+        """A django Q object selecting subjects that meet the condition.
+        Each code is matched with a subquery on Fact.
+        """
+        if self.negated:
+            return ~self.children[0].subject_q(survey, content_type)
+        if self.children:
+            left, right = [child.subject_q(survey, content_type)
+                    for child in self.children]
+            return left & right if self.connector == self.AND else left | right
+
+        facts = _get_facts(survey, content_type=content_type, **self.lookups)\
+                .filter(desired_fact__code=self.code,
+                        desired_fact__content_type=content_type)
+        return Q(pk__in=_get_subject_ids_for_facts(facts))
+
+def filter_subjects(survey, subjects_qs, condition):
+    """Return the subjects in subjects_qs that meet a FactQ condition. The
+    result is a queryset, so it can be passed on to the aggregate helpers,
+    e.g. sum_facts(survey, filter_subjects(survey, qs, condition), income).
+    """
+    content_type = ContentType.objects.get_for_model(subjects_qs.model)
+    return subjects_qs.filter(condition.subject_q(survey, content_type))
+
+def get_typed_data(survey, subjects_qs, desired_facts=None):
+    """Return (fact, typed_data) pairs for all facts about the subjects,
+    optionally restricted to some desired facts, resolving typed data for
+    all the facts at once.
+    """
+    facts = _get_facts(survey, subjects_qs=subjects_qs,
+            desired_facts=desired_facts)
+    return typed_data_for_facts(facts)
+
+def aggregate_facts(survey, subjects_qs, desired_facts, function):
+    """Get all the facts matching a desired fact for a particular
+    survey and content_type. Aggregate the facts' data in the database with
+    one of SUM, AVG, MIN, MAX or COUNT.
+    """
+    facts = _get_facts(survey, subjects_qs=subjects_qs,
+            desired_facts=desired_facts)
+    return _aggregate(facts, function)
+
 def sum_facts(survey, subjects_qs, desired_facts):
     """Get all the facts matching a desired fact for a particular
     survey and content_type. Sum the facts' data.
     """
-    to_sum = _get_facts(survey, subjects_qs=subjects_qs,
-            desired_facts=desired_facts)
-    return sum([fact.typed_data for fact in to_sum])
+    return aggregate_facts(survey, subjects_qs, desired_facts, SUM)
+
+def avg_facts(survey, subjects_qs, desired_facts):
+    return aggregate_facts(survey, subjects_qs, desired_facts, AVG)
+
+def min_facts(survey, subjects_qs, desired_facts):
+    return aggregate_facts(survey, subjects_qs, desired_facts, MIN)
+
+def max_facts(survey, subjects_qs, desired_facts):
+    return aggregate_facts(survey, subjects_qs, desired_facts, MAX)
+
+def count_facts(survey, subjects_qs, desired_facts):
+    return aggregate_facts(survey, subjects_qs, desired_facts, COUNT)
+
+def aggregate_facts_where(survey, subjects_qs, agg_dfs, function,
+        match_df=None, match_value=None):
+    """Find all subjects whose facts match the criteria. For those
+    subjects, obtain facts related to agg_dfs and aggregate them with one
+    of SUM, AVG, MIN, MAX or COUNT.
+    """
+    if not isinstance(agg_dfs, (list, tuple)):
+        agg_dfs = [agg_dfs]
+
+    # first get all subject_ids that have the required fact
+    facts = _get_facts(survey, subjects_qs=subjects_qs,
+            desired_facts=match_df, value=match_value)
+
+    subject_ids = _get_subject_ids_for_facts(facts)
+
+    # Get all the agg_dfs for these subjects, and aggregate them
+    content_type = ContentType.objects.get_for_model(subjects_qs.model)
+    to_aggregate = Fact.objects.filter(survey=survey,
+            content_type=content_type, desired_fact__in=agg_dfs,
+            object_id__in=subject_ids)
+
+    return _aggregate(to_aggregate, function)
 
 def sum_facts_where(survey, subjects_qs, sum_dfs, match_df=None,
         match_value=None):
@@ -61,25 +271,28 @@ def sum_facts_where(survey, subjects_qs, sum_dfs, match_df=None,
     households with a colour television, and sum the monthly income of 
     those households.
     """
-    if not isinstance(sum_dfs, (list, tuple)):
-        sum_dfs = [sum_dfs]
-
-    # first get all subject_ids that have the required fact
-    facts = _get_facts(survey, subjects_qs=subjects_qs,
-            desired_facts=match_df, value=match_value)
+    return aggregate_facts_where(survey, subjects_qs, sum_dfs, SUM,
+            match_df=match_df, match_value=match_value)
 
-    subject_ids = _get_subject_ids_for_facts(facts)
+def avg_facts_where(survey, subjects_qs, avg_dfs, match_df=None,
+        match_value=None):
+    return aggregate_facts_where(survey, subjects_qs, avg_dfs, AVG,
+            match_df=match_df, match_value=match_value)
 
-    # Get all the sum_dfs for these subjects, and sum them
-    if subject_ids:
-        content_type = facts[0].content_type
+def min_facts_where(survey, subjects_qs, min_dfs, match_df=None,
+        match_value=None):
+    return aggregate_facts_where(survey, subjects_qs, min_dfs, MIN,
+            match_df=match_df, match_value=match_value)
 
-        to_sum = Fact.objects.filter(survey=survey, content_type=content_type,
-                desired_fact__in=sum_dfs, object_id__in=subject_ids)
+def max_facts_where(survey, subjects_qs, max_dfs, match_df=None,
+        match_value=None):
+    return aggregate_facts_where(survey, subjects_qs, max_dfs, MAX,
+            match_df=match_df, match_value=match_value)
 
-        return sum([fact.typed_data for fact in to_sum])
-    else:
-        return 0
+def count_facts_where(survey, subjects_qs, count_dfs, match_df=None,
+        match_value=None):
+    return aggregate_facts_where(survey, subjects_qs, count_dfs, COUNT,
+            match_df=match_df, match_value=match_value)
 
 def get_number_of_subjects_where(survey, subjects_qs, match_df, match_value):
     """Return the number of subjects about which we have recorded
@@ -87,4 +300,94 @@ def get_number_of_subjects_where(survey, subjects_qs, match_df, match_value):
     """
     facts = _get_facts(survey, subjects_qs=subjects_qs, 
             desired_facts=match_df, value=match_value)
-    return len(_get_subject_ids_for_facts(facts))
+    return _get_subject_ids_for_facts(facts).count()
+
+def _option_labels(desired_fact):
+    """Return [(code, description), ...] for the desired fact's options."""
+    if desired_fact.data_type == YES_NO:
+        return [(str(YES_CODE), 'Yes'), (str(NO_CODE), 'No')]
+    return list(FactOption.objects.filter(desired_fact=desired_fact)
+            .order_by('code').values_list('code', 'description'))
+
+def _labels_with_data(labels, codes):
+    """Add (code, code) labels for any codes in the data without options."""
+    known = set(code for code, description in labels)
+    return labels + [(code, code) for code in sorted(codes) if code not in known]
+
+def _grouped_counts(survey, subjects_qs, group_dfs, weight_df=None):
+    """Count the subjects with each combination of values for group_dfs, or
+    with weight_df, sum its numeric data over those subjects, using a single
+    GROUP BY query. Return {(value, ...): count_or_sum, ...}.
+    """
+    facts = _get_facts(survey, subjects_qs=subjects_qs).order_by()
+    connection = connections[facts.db]
+    qn = connection.ops.quote_name
+
+    subqueries = [facts.filter(desired_fact=df).values_list('object_id', 'data')
+            for df in group_dfs]
+    if weight_df is not None:
+        subqueries.append(facts.filter(desired_fact=weight_df)\
+                .values_list('object_id', 'numeric_data'))
+
+    compiled, params = [], []
+    try:
+        for subquery in subqueries:
+            sql, subquery_params = subquery.query\
+                    .get_compiler(connection=connection).as_sql()
+            compiled.append(sql)
+            params.extend(subquery_params)
+    except EmptyResultSet:
+        return {}
+
+    aliases = ['f%d' % i for i in range(len(compiled))]
+    from_clause = '(%s) %s' % (compiled[0], aliases[0])
+    for sql, alias in zip(compiled[1:], aliases[1:]):
+        from_clause += ' INNER JOIN (%s) %s ON %s.%s = %s.%s' % (sql, alias,
+                aliases[0], qn('object_id'), alias, qn('object_id'))
+
+    group_columns = ['%s.%s' % (alias, qn('data'))
+            for alias in aliases[:len(group_dfs)]]
+    if weight_df is not None:
+        value = 'SUM(%s.%s)' % (aliases[-1], qn('numeric_data'))
+    else:
+        value = 'COUNT(DISTINCT %s.%s)' % (aliases[0], qn('object_id'))
+
+    sql = 'SELECT %s, %s FROM %s GROUP BY %s' % (', '.join(group_columns),
+            value, from_clause, ', '.join(group_columns))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return dict((tuple(row[:-1]), row[-1] or 0) for row in cursor.fetchall())
+
+def frequency_table(survey, subjects_qs, desired_fact, weight_df=None):
+    """Return [(code, description, frequency), ...] for every option of a
+    choice desired fact, giving the number of subjects with each option.
+
+    If weight_df is given, the frequency is the sum of that numeric desired
+    fact over those subjects instead.
+    """
+    counts = _grouped_counts(survey, subjects_qs, [desired_fact], weight_df)
+    labels = _labels_with_data(_option_labels(desired_fact),
+            [code for code, in counts])
+    return [(code, description, counts.get((code,), 0))
+            for code, description in labels]
+
+def crosstab(survey, subjects_qs, row_df, column_df, weight_df=None):
+    """Return (row_labels, column_labels, cells) for a two-way frequency
+    table of two choice desired facts. The labels are [(code, description),
+    ...] lists, and cells is {(row_code, column_code): frequency, ...} with
+    an entry for every combination.
+
+    If weight_df is given, frequencies are sums of that numeric desired
+    fact rather than numbers of subjects.
+    """
+    counts = _grouped_counts(survey, subjects_qs, [row_df, column_df],
+            weight_df)
+    row_labels = _labels_with_data(_option_labels(row_df),
+            set(row_code for row_code, column_code in counts))
+    column_labels = _labels_with_data(_option_labels(column_df),
+            set(column_code for row_code, column_code in counts))
+    cells = dict(((row_code, column_code),
+                counts.get((row_code, column_code), 0))
+            for row_code, row_description in row_labels
+            for column_code, column_description in column_labels)
+    return row_labels, column_labels, cells
@@ -0,0 +1,91 @@
+from survey.tests.utils import SurveyTestCase
+from survey.models import (DesiredFact, DesiredFactGroup, FactOption,
+        SurveyDesiredFact, Survey, SurveyProgress, Fact, rebuild_progress)
+from survey.create_survey import create_desired_facts, CREATE, UPDATE
+
+class CreateDesiredFactsTests(SurveyTestCase):
+    def setUp(self):
+        super(CreateDesiredFactsTests, self).setUp()
+        self.new_survey = Survey.objects.create(project=self.project,
+                name='survey2')
+
+    def _defns(self, label='Colour', description='Red'):
+        return {self.content_type: [{
+            'heading': 'Appearance',
+            'desired_facts': [{
+                'code': 'colour', 'label': label, 'data_type': 'S',
+                'choices': [('1', description), ('2', 'Blue')],
+            }, {
+                'code': 'code1', 'label': 'enter data', 'data_type': 'T',
+            }],
+        }]}
+
+    def test_create(self):
+        report = create_desired_facts(self.new_survey, self._defns())
+        self.assertEquals(1, report.count(CREATE, 'DesiredFactGroup'))
+        # code1 already exists, and is reused
+        self.assertEquals(1, report.count(CREATE, 'DesiredFact'))
+        self.assertEquals(2, report.count(CREATE, 'FactOption'))
+        self.assertEquals(2, report.count(CREATE, 'SurveyDesiredFact'))
+
+        sdfs = SurveyDesiredFact.objects.filter(survey=self.new_survey)\
+                .order_by('weight')
+        self.assertEquals([('colour', 'Appearance'), ('code1', 'Appearance')],
+                [(sdf.desired_fact.code, sdf.fact_group.heading)
+                    for sdf in sdfs])
+        self.assertEquals(self.desired_fact, sdfs[1].desired_fact)
+        self.assertEquals(['Red', 'Blue'], list(FactOption.objects
+                .filter(desired_fact__code='colour').order_by('code')
+                .values_list('description', flat=True)))
+
+    def test_reload_updates(self):
+        create_desired_facts(self.new_survey, self._defns())
+        report = create_desired_facts(self.new_survey,
+                self._defns(label='Colour?', description='Crimson'))
+
+        self.assertEquals([(UPDATE, 'DesiredFact'), (UPDATE, 'FactOption')],
+                [change[:2] for change in report.changes])
+        self.assertEquals(1, DesiredFact.objects.filter(code='colour').count())
+        self.assertEquals('Colour?',
+                DesiredFact.objects.get(code='colour').label)
+        self.assertEquals('Crimson', FactOption.objects.get(code='1').description)
+
+    def test_reload_unchanged(self):
+        create_desired_facts(self.new_survey, self._defns())
+        with self.assertNumQueries(4):
+            report = create_desired_facts(self.new_survey, self._defns())
+        self.assertEquals(0, len(report))
+
+    def test_reload_shared_desired_facts(self):
+        self.login()
+        other = DesiredFact.objects.create(code='other', label='other',
+                data_type='T', required=True, content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=other)
+        fact = self._save_fact('12')
+        rebuild_progress(self.survey)
+        progress = SurveyProgress.objects.filter(survey=self.survey)\
+                .values_list('subjects_started', 'subjects_completed')
+        self.assertEquals([(1, 0)], list(progress.all()))
+
+        # both desired facts are also in self.survey
+        create_desired_facts(self.new_survey, {self.content_type: [{
+            'heading': 'Shared',
+            'desired_facts': [
+                {'code': 'code1', 'label': 'enter data', 'data_type': 'I'},
+                {'code': 'other', 'label': 'other', 'data_type': 'T',
+                    'required': False},
+            ],
+        }]})
+
+        self.assertEquals([(1, 1)], list(progress.all()))
+        self.assertEquals(12.0, Fact.objects.get(pk=fact.pk).numeric_data)
+
+    def test_dry_run(self):
+        report = create_desired_facts(self.new_survey, self._defns(),
+                dry_run=True)
+        self.assertTrue(report.dry_run)
+        self.assertEquals(6, len(report))
+        self.assertFalse(DesiredFact.objects.filter(code='colour').exists())
+        self.assertFalse(DesiredFactGroup.objects
+                .filter(heading='Appearance').exists())
@@ -1,9 +1,20 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
 from unittest import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 from django.utils.datastructures import MultiValueDict
 
 from survey.tests.utils import SurveyTestCase
-from survey.models import Fact, Project
-from survey.export import export_subject, export_subjects, ExcelExport
+from survey import export
+from survey.models import (Fact, Project, ExportManifest, ExportJob, CSV,
+        DONE, FAILED)
+from survey.export import (export_subject, export_subjects,
+        iter_export_subjects, iter_survey_subjects, count_subjects,
+        last_export_watermark, run_export_job, ExcelExport)
 
 class ExportTests(SurveyTestCase):
     def setUp(self):
@@ -36,6 +47,137 @@ class ExportTests(SurveyTestCase):
         self.assertEquals(1, len(export_data))
         self.assertEquals('a', export_data[self.desired_fact.code])
 
+    def test_export_subjects_constant_queries(self):
+        for i in range(5):
+            subject = Project.objects.create(name='subject_standin')
+            Fact.objects.create(subject=subject, survey=self.survey,
+                    desired_fact=self.desired_fact, data=str(i),
+                    created_by=self.user, updated_by=self.user)
+        Project.objects.create(name='subject_standin')
+
+        qs = Project.objects.filter(name='subject_standin').order_by('id')
+        with self.assertNumQueries(2):
+            export = export_subjects(self.survey, qs)
+
+        self.assertEquals(list(qs), list(export.keys()))
+        self.assertEquals(['a', '0', '1', '2', '3', '4'],
+                [data.get(self.desired_fact.code)
+                    for data in list(export.values())[:-1]])
+        self.assertEquals(0, len(list(export.values())[-1]))
+
+    def test_iter_export_subjects(self):
+        subject2 = Project.objects.create(name='subject_standin')
+        subject3 = Project.objects.create(name='subject_standin')
+        Fact.objects.create(subject=subject3, survey=self.survey,
+                desired_fact=self.desired_fact, data='c', created_by=self.user,
+                updated_by=self.user)
+
+        qs = Project.objects.filter(name='subject_standin')
+        pairs = list(iter_export_subjects(self.survey, qs, chunk_size=2))
+
+        self.assertEquals([self.subject, subject2, subject3],
+                [subject for subject, data in pairs])
+        self.assertEquals(['a', None, 'c'],
+                [data.get(self.desired_fact.code) for subject, data in pairs])
+
+    def test_export_subjects_since(self):
+        since = timezone.now() + timedelta(seconds=1)
+        subject2 = Project.objects.create(name='subject_standin')
+        Fact.objects.create(subject=subject2, survey=self.survey,
+                desired_fact=self.desired_fact, data='b', created_by=self.user,
+                updated_by=self.user)
+        Fact.objects.filter(object_id=subject2.pk)\
+                .update(updated_on=since + timedelta(seconds=1))
+
+        qs = Project.objects.filter(name='subject_standin')
+        self.assertEquals([subject2],
+                list(export_subjects(self.survey, qs, since=since).keys()))
+        self.assertEquals([subject2],
+                [subject for subject, data
+                    in iter_export_subjects(self.survey, qs, since=since)])
+
+    def test_export_subjects_since_includes_deletions(self):
+        since = timezone.now() - timedelta(seconds=1)
+        Fact.objects.update(updated_on=since - timedelta(seconds=1))
+        self.desired_fact.data_type = 'M'
+        self.desired_fact.save()
+        content_type = ContentType.objects.get_for_model(self.subject)
+        Fact.bulk_create_or_update(self.survey, content_type, self.subject.pk,
+                [(self.desired_fact, [])], self.user)
+
+        qs = Project.objects.filter(name='subject_standin')
+        export = export_subjects(self.survey, qs, since=since)
+        self.assertEquals([self.subject], list(export.keys()))
+        self.assertEquals(0, len(export[self.subject]))
+
+    def test_last_export_watermark_for_content_type(self):
+        now = timezone.now()
+        ExportManifest.objects.create(survey=self.survey,
+                content_type=self.content_type, filename='export.csv',
+                watermark=now)
+        # an export of one content type doesn't cover the others
+        self.assertEquals(None, last_export_watermark(self.survey))
+        self.assertEquals(now,
+                last_export_watermark(self.survey, self.content_type))
+
+    def test_iter_survey_subjects(self):
+        # a project without facts in the survey isn't one of its subjects
+        Project.objects.create(name='subject_standin')
+
+        self.assertEquals([self.subject], [subject for subject, data
+                in iter_survey_subjects(self.survey, self.content_type)])
+        self.assertEquals(1, count_subjects(self.survey, [self.content_type]))
+
+    def test_last_export_watermark(self):
+        self.assertEquals(None, last_export_watermark(self.survey))
+        now = timezone.now()
+        for watermark in (now, now - timedelta(days=1)):
+            ExportManifest.objects.create(survey=self.survey,
+                    filename='export.xlsx', watermark=watermark)
+        self.assertEquals(now, last_export_watermark(self.survey))
+
+
+class ExportJobTests(SurveyTestCase):
+    def setUp(self):
+        super(ExportJobTests, self).setUp()
+        self.login()
+        self._save_fact('a')
+        self.spreadsheets_root = export.SPREADSHEETS_ROOT
+        export.SPREADSHEETS_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(export.SPREADSHEETS_ROOT)
+        export.SPREADSHEETS_ROOT = self.spreadsheets_root
+
+    def test_run_csv_job(self):
+        job = ExportJob.objects.create(survey=self.survey, format=CSV,
+                content_type=self.content_type, created_by=self.user)
+        run_export_job(job)
+
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEquals(DONE, job.status)
+        # the survey's project has no facts, so isn't a subject
+        self.assertEquals((1, 1), (job.rows_done, job.rows_total))
+        path = os.path.join(export.SPREADSHEETS_ROOT, job.filename)
+        with open(path) as output:
+            lines = output.read().splitlines()
+        self.assertEquals(['code1', 'a'], lines)
+        manifest = ExportManifest.objects.get()
+        self.assertEquals((self.content_type, job.filename),
+                (manifest.content_type, manifest.filename))
+
+    def test_run_failing_job(self):
+        job = ExportJob.objects.create(survey=self.survey, format=CSV,
+                created_by=self.user)
+        run_export_job(job)
+
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEquals(FAILED, job.status)
+        # just the error, without the traceback
+        self.assertTrue(job.error)
+        self.assertFalse('Traceback' in job.error)
+        self.assertEquals(1, len(job.error.splitlines()))
+
 
 CODE = 'code1'
 MULTI_CODE = 'code_multi'
@@ -67,3 +209,96 @@ class ExcelExportTests(TestCase):
     def test_make_cell_present_multi_value(self):
         self.assertEquals('val1, val2', self.export.make_cell(self.data, MULTI_CODE))
 
+    def test_make_multi_rows(self):
+        self.data.setlist('other_multi', ['o1', 'o2'])
+        rows = self.export.make_multi_rows(MULTI_CODE, self.data,
+                [MULTI_CODE, CODE, 'other_multi', 'not_present'])
+
+        self.assertEquals([['val1', 'val', 'o1', ''],
+                           ['val2', 'val', 'o2', '']], rows)
+        self.assertEquals(['val1', 'val2'], self.data.getlist(MULTI_CODE))
+
+    def test_make_multi_rows_no_values(self):
+        self.assertEquals([], self.export.make_multi_rows('not_present',
+            self.data, [CODE]))
+
+    def _export(self, processes, content_types=('type1', 'type2')):
+        data = self.data
+        self.fetches = fetches = []
+
+        class StaticExport(ExcelExport):
+            def get_subjects_data(self, content_type):
+                fetches.append(content_type)
+                return [('s%s' % i, data) for i in range(3)]
+
+        defn = OrderedDict([
+            ('type1', [{'title': 'a', 'codes': [CODE]},
+                       {'title': 'b', 'codes': [MULTI_CODE, CODE]}]),
+            ('type2', [{'title': 'c', 'codes': [MULTI_CODE]}])])
+        defn = OrderedDict((content_type, defn[content_type])
+                for content_type in content_types)
+        return StaticExport(defn, processes=processes,
+                multi_row_data={'b': MULTI_CODE})
+
+    def _sheets(self, export):
+        sheets = []
+        for content_type, type_sheets, rows in export.iter_content_types():
+            rows_by_sheet = [[] for sheet in type_sheets]
+            for index, row in rows:
+                rows_by_sheet[index].append(row)
+            sheets.extend(zip(type_sheets, rows_by_sheet))
+        return sheets
+
+    def test_subjects_data_fetched_once_per_content_type(self):
+        sheets = self._sheets(self._export(processes=1))
+        self.assertEquals(['type1', 'type2'], self.fetches)
+        self.assertEquals([['val']] * 3, sheets[0][1])
+        self.assertEquals([['val1', 'val'], ['val2', 'val']] * 3,
+                sheets[1][1])
+        self.assertEquals([['val1, val2']] * 3, sheets[2][1])
+
+    def test_parallel_sheets_match_serial(self):
+        self.assertEquals(self._sheets(self._export(processes=1)),
+                self._sheets(self._export(processes=2)))
+
+    def test_parallel_with_one_content_type(self):
+        serial = self._sheets(self._export(processes=1,
+                content_types=['type1']))
+        export = self._export(processes=2, content_types=['type1'])
+        self.assertEquals(serial, self._sheets(export))
+        # the data was fetched, and the worksheets built, by workers
+        self.assertEquals([], self.fetches)
+
+    def _rows_files_left(self, consume):
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = tempfile.mkdtemp()
+        try:
+            consume(self._export(processes=2))
+            return os.listdir(tempfile.tempdir)
+        finally:
+            shutil.rmtree(tempfile.tempdir)
+            tempfile.tempdir = tempdir
+
+    def test_parallel_rows_files_removed_when_abandoned(self):
+        def consume(export):
+            content_types = export.iter_content_types()
+            content_type, sheets, rows = next(content_types)
+            next(rows)
+            content_types.close()
+            rows.close()
+        self.assertEquals([], self._rows_files_left(consume))
+
+    def test_parallel_rows_files_removed_on_failure(self):
+        def consume(export):
+            def fail(content_type):
+                raise ValueError(content_type)
+            export.get_subjects_data = fail
+            self.assertRaises(ValueError, self._sheets, export)
+        self.assertEquals([], self._rows_files_left(consume))
+
+    def test_output_data_from_generator(self):
+        worksheet = []
+        subjects_data = (pair for pair in [('s1', self.data), ('s2', self.data)])
+        self.export.output_data(worksheet, 'title', [CODE], subjects_data)
+        self.assertEquals([['val'], ['val']], worksheet)
+
@@ -0,0 +1,64 @@
+from unittest import skipIf
+
+from survey.tests.utils import SurveyTestCase
+from survey.models import Fact, Project, DesiredFact, FactOption, \
+        SurveyDesiredFact
+
+try:
+    import numpy
+    from survey.extract import extract_table
+except ImportError:
+    numpy = None
+
+
+@skipIf(numpy is None, 'numpy is not installed')
+class ExtractTableTests(SurveyTestCase):
+    def setUp(self):
+        super(ExtractTableTests, self).setUp()
+        self.login()
+        self.desired_fact.data_type = 'S'
+        self.desired_fact.save()
+        FactOption.objects.create(desired_fact=self.desired_fact,
+                code='01', description='red')
+        FactOption.objects.create(desired_fact=self.desired_fact,
+                code='02', description='blue')
+
+        self.dfs = [self.desired_fact]
+        for code, data_type in [('income', 'F'), ('tv', 'Y')]:
+            df = DesiredFact.objects.create(code=code, label=code,
+                    data_type=data_type, required=True,
+                    content_type=self.content_type)
+            SurveyDesiredFact.objects.create(survey=self.survey,
+                    fact_group=self.fact_group, desired_fact=df, weight=2)
+            self.dfs.append(df)
+
+        self.subject2 = Project.objects.create(name='subject_standin2')
+        for subject, data in [(self.subject, ['02', '1.5', '1']),
+                              (self.subject2, [None, '3', '2'])]:
+            for df, value in zip(self.dfs, data):
+                Fact.create_or_update(self.survey, df, self.content_type,
+                        subject.id, value, self.user)
+
+    def test_extract_table(self):
+        table = extract_table(self.survey, self.content_type)
+
+        self.assertEquals(2, len(table))
+        self.assertEquals([self.subject.id, self.subject2.id],
+                list(table.subject_ids))
+        self.assertEquals(['code1', 'income', 'tv'], list(table.columns))
+        self.assertEquals(['01', '02'], table.categories['code1'])
+        self.assertEquals([1, -1], list(table['code1']))
+        self.assertEquals([1.5, 3.0], list(table['income']))
+        self.assertEquals([True, False], list(table['tv']))
+
+    def test_missing_values(self):
+        Fact.objects.filter(desired_fact=self.dfs[1],
+                object_id=self.subject2.id).delete()
+        Fact.objects.filter(desired_fact=self.dfs[2],
+                object_id=self.subject.id).delete()
+
+        table = extract_table(self.survey, self.content_type)
+
+        self.assertTrue(numpy.isnan(table['income'][1]))
+        self.assertTrue(table['tv'].mask[0])
+        self.assertFalse(table['tv'].mask[1])
@@ -58,6 +58,46 @@ class FactFormTests(SurveyTestCase):
             desired_fact=self.desired_fact, data='02').exists())
 
 
+class SurveyFormCacheTests(SurveyTestCase):
+    def test_form_class_cached(self):
+        cls = forms.make_survey_form_subclass(self.survey, self.content_type)
+        with self.assertNumQueries(0):
+            self.assertTrue(cls is forms.make_survey_form_subclass(
+                self.survey, self.content_type))
+
+    def test_options_loaded_in_one_query(self):
+        from survey.models import DesiredFact, SurveyDesiredFact
+        self.desired_fact.data_type = 'S'
+        self.desired_fact.save()
+        for i in range(3):
+            df = DesiredFact.objects.create(code='multi%s' % i, label='m',
+                    data_type='M', required=True, content_type=self.content_type)
+            SurveyDesiredFact.objects.create(survey=self.survey,
+                    fact_group=self.fact_group, desired_fact=df)
+            FactOption.objects.create(desired_fact=df, code='01',
+                    description='a')
+
+        # one query for the survey desired facts, one for all their options
+        with self.assertNumQueries(2):
+            cls = forms._make_survey_form_subclass(self.survey,
+                    self.content_type)
+        self.assertEquals([('', 'Make a selection'), ('01', '1-a')],
+                cls.base_fields['multi0'].choices)
+
+    def test_cache_invalidated_by_definition_change(self):
+        self.desired_fact.data_type = 'S'
+        self.desired_fact.save()
+        cls = forms.make_survey_form_subclass(self.survey, self.content_type)
+
+        FactOption.objects.create(desired_fact=self.desired_fact,
+                code='01', description='1')
+        new_cls = forms.make_survey_form_subclass(self.survey, self.content_type)
+
+        self.assertFalse(cls is new_cls)
+        self.assertEquals([('', 'Make a selection'), ('01', '1-1')],
+                new_cls.base_fields['code1'].choices)
+
+
 class FactFieldDataTypeTests(SurveyTestCase):
 
     def setUp(self):
@@ -166,6 +206,34 @@ class MultiSelectFactFieldTests(SurveyTestCase):
         form.create_fact(['01'], self.desired_fact, self.content_type)
         self.assertTrue(self._get_fact('01') is not None)
 
+    def test_save_valid_uses_overridden_create_fact(self):
+        created = []
+        class CustomForm(self._create_bound_form_with_field_type('M',
+                ['01']).__class__):
+            def create_fact(self, data, desired_fact, content_type):
+                created.append((data, desired_fact.code))
+        form = CustomForm(self.survey, self.subject, self.user,
+                data={'code1': ['01']})
+        form.save_valid()
+        self.assertEquals([(['01'], 'code1')], created)
+        self.assertFalse(Fact.objects.exists())
+
+    def test_overridden_create_fact_calling_super(self):
+        created = []
+        class CustomForm(self._create_bound_form_with_field_type('M',
+                ['01']).__class__):
+            def create_fact(self, data, desired_fact, content_type):
+                created.append(data)
+                super(CustomForm, self).create_fact(data, desired_fact,
+                        content_type)
+        for data in (['01'], ['02']):
+            CustomForm(self.survey, self.subject, self.user,
+                    data={'code1': data}).save_valid()
+        self.assertEquals([['01'], ['02']], created)
+        self.assertEquals(['02'], list(Fact.objects
+                .filter(desired_fact=self.desired_fact)
+                .values_list('data', flat=True)))
+
     def test_create_again(self):
         "subsequent calls with same data should not create more facts"
         form = self._create_bound_form_with_field_type('M')
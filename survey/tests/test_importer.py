@@ -0,0 +1,127 @@
+import os
+import tempfile
+from io import BytesIO
+
+import openpyxl
+
+from survey.tests.utils import SurveyTestCase
+from survey.models import (DesiredFact, FactOption, SurveyDesiredFact, Fact,
+        YES_CODE)
+from survey.importer import FactImporter, cell_text, numbered_option_codes
+
+class FactImporterTests(SurveyTestCase):
+    def setUp(self):
+        super(FactImporterTests, self).setUp()
+        self.login()
+        self.multi_fact = DesiredFact.objects.create(code='code2',
+                label='choose', data_type='M', required=False,
+                content_type=self.content_type)
+        for code in ('01', '02'):
+            FactOption.objects.create(code=code, description=code,
+                    desired_fact=self.multi_fact)
+        self.int_fact = DesiredFact.objects.create(code='code3',
+                label='count', data_type='I', required=False,
+                content_type=self.content_type)
+        for df in (self.multi_fact, self.int_fact):
+            SurveyDesiredFact.objects.create(survey=self.survey,
+                    fact_group=self.fact_group, desired_fact=df)
+
+    def _import(self, lines, batch_size=1000):
+        importer = FactImporter(self.survey, self.content_type, self.user,
+                batch_size=batch_size)
+        return importer.import_csv(BytesIO('\n'.join(lines)))
+
+    def _data(self, desired_fact, subject=None):
+        subject = subject or self.subject
+        return sorted(Fact.objects.filter(desired_fact=desired_fact,
+                object_id=subject.id).values_list('data', flat=True))
+
+    def test_import(self):
+        report = self._import(['id,code1,code2,code3',
+                '%d,text,"01, 02",3' % self.subject.id])
+        self.assertEquals([], report.errors)
+        self.assertEquals((1, 4), (report.rows, report.created))
+        self.assertEquals(['text'], self._data(self.desired_fact))
+        self.assertEquals(['01', '02'], self._data(self.multi_fact))
+        self.assertEquals(['3'], self._data(self.int_fact))
+        self.assertEquals(1, SurveyDesiredFact.objects\
+                .get(desired_fact=self.int_fact).facts_collected)
+
+    def test_import_updates(self):
+        self._save_fact('old')
+        self._save_fact('01', desired_fact=self.multi_fact)
+        report = self._import(['id,code1,code2,code3',
+                '%d,new,02,' % self.subject.id])
+        self.assertEquals((1, 1, 1),
+                (report.created, report.updated, report.deleted))
+        self.assertEquals(['new'], self._data(self.desired_fact))
+        self.assertEquals(['02'], self._data(self.multi_fact))
+        self.assertEquals([], self._data(self.int_fact))
+
+    def test_multi_values_over_several_rows(self):
+        self._import(['id,code2', '%d,01' % self.subject.id,
+                '%d,02' % self.subject.id], batch_size=1)
+        self.assertEquals(['01', '02'], self._data(self.multi_fact))
+
+    def test_errors(self):
+        report = self._import(['id,code3,unknown',
+                '%d,not a number,' % self.subject.id,
+                '999999,3,', ',3,'])
+        self.assertEquals([(1, 'unknown'), (2, 'code3'), (3, 'id'), (4, 'id')],
+                sorted((row_number, code)
+                    for sheet, row_number, code, message in report.errors))
+        self.assertEquals(0, Fact.objects.count())
+
+    def test_batches(self):
+        subjects = [self.subject, self.project]
+        lines = ['id,code3'] + ['%d,%d' % (subject.id, i)
+                for i, subject in enumerate(subjects)]
+        report = self._import(lines, batch_size=1)
+        self.assertEquals(2, report.created)
+        self.assertEquals([['0'], ['1']],
+                [self._data(self.int_fact, subject) for subject in subjects])
+
+    def test_skips_sheet_without_identifier(self):
+        report = self._import(['code1', 'text'])
+        self.assertEquals([''], report.skipped_sheets)
+        self.assertEquals(0, Fact.objects.count())
+
+    def test_cell_text(self):
+        self.assertEquals(u'', cell_text(None))
+        self.assertEquals(u'3', cell_text(3.0))
+        self.assertEquals(u'3.5', cell_text(3.5))
+        self.assertEquals(u'a', cell_text(u' a '))
+
+    def test_numbered_option_codes(self):
+        self.assertEquals({u'2': '02'},
+                numbered_option_codes([('', ''), ('1', 'a'), ('01', 'b'),
+                    ('02', 'c'), ('x', 'd')]))
+
+    def test_import_yes_no(self):
+        yes_no_fact = DesiredFact.objects.create(code='code4',
+                label='yes or no', data_type='Y', required=False,
+                content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=yes_no_fact)
+
+        report = self._import(['id,code4', '%d,%d' % (self.subject.id,
+                YES_CODE)])
+        self.assertEquals([], report.errors)
+        self.assertEquals([unicode(YES_CODE)], self._data(yes_no_fact))
+
+    def test_import_workbook_with_numbered_option_codes(self):
+        workbook = openpyxl.Workbook()
+        worksheet = workbook.worksheets[0]
+        worksheet.append(['id', 'code2'])
+        # as a spreadsheet stores an option code of 02 typed into a cell
+        worksheet.append([self.subject.id, 2.0])
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            workbook.save(path)
+            importer = FactImporter(self.survey, self.content_type, self.user)
+            report = importer.import_workbook(path)
+        finally:
+            os.remove(path)
+        self.assertEquals([], report.errors)
+        self.assertEquals(['02'], self._data(self.multi_fact))
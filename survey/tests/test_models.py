@@ -1,9 +1,16 @@
+from datetime import timedelta
+
+from django.core.signals import request_finished
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 
 from survey.tests.utils import SurveyTestCase
 from survey.models import (DesiredFact, FactOption,
-        Fact, has_required_data, Project)
+        Fact, has_required_data, Project, typed_data_for_facts,
+        missing_required_data, SurveyDesiredFact, SurveyProgress,
+        rebuild_progress, ExportJob, PENDING, RUNNING, FAILED, survey_schema,
+        numeric_value, schema_version, incomplete_subject_pks)
 
 
 class DesiredFactTests(TestCase):
@@ -49,6 +56,31 @@ class FactTests(SurveyTestCase):
         fact = self._save_fact(data)
         self.assertEquals(12.2, fact.typed_data)
 
+    def test_numeric_data(self):
+        self._set_desired_fact_data_type('I')
+        self.assertEquals(12.0, self._save_fact('12').numeric_data)
+        self.assertEquals(None, self._save_fact('').numeric_data)
+
+        self._set_desired_fact_data_type('Y')
+        self.assertEquals(0.0, self._save_fact('2').numeric_data)
+
+        self._set_desired_fact_data_type('T')
+        self.assertEquals(None, self._save_fact('12').numeric_data)
+
+    def test_numeric_data_not_finite(self):
+        for data_type in ('I', 'F', 'Y'):
+            for data in ('nan', 'inf', '-inf'):
+                self.assertEquals(None, numeric_value(data_type, data))
+
+    def test_save_unchanged_fact_without_loading_desired_fact(self):
+        self._set_desired_fact_data_type('I')
+        fact = Fact.objects.get(pk=self._save_fact('12').pk)
+        fact.updated_by = self.user
+        # the existence check and update that Model.save makes
+        with self.assertNumQueries(2):
+            fact.save()
+        self.assertEquals(12.0, fact.numeric_data)
+
     def test_data_type_yes_no(self):
         data = '01'
         self._set_desired_fact_data_type('Y')
@@ -62,6 +94,89 @@ class FactTests(SurveyTestCase):
         fact = self._save_fact(data)
         self.assertEquals(fo, fact.typed_data)
 
+    def test_typed_data_for_facts(self):
+        self._set_desired_fact_data_type('S')
+        fo1 = FactOption.objects.create(desired_fact=self.desired_fact,
+                code='01')
+        fo2 = FactOption.objects.create(desired_fact=self.desired_fact,
+                code='02')
+        int_df = DesiredFact.objects.create(code='code2', label='l',
+                data_type='I', required=True, content_type=self.content_type)
+        self._save_fact('01')
+        self._save_fact('02')
+        self._save_fact('02')
+        self._save_fact('7', desired_fact=int_df)
+
+        facts = Fact.objects.order_by('id')
+        # facts, desired facts and options
+        with self.assertNumQueries(3):
+            typed_data = typed_data_for_facts(facts)
+        self.assertEquals([fo1, fo2, fo2, 7],
+                [value for fact, value in typed_data])
+        self.assertEquals([fact.typed_data for fact in facts],
+                [value for fact, value in typed_data])
+
+    def _bulk_create_or_update(self, *fact_data):
+        Fact.bulk_create_or_update(self.survey, self.content_type,
+                self.subject.id, fact_data, self.user)
+
+    def test_bulk_create_or_update(self):
+        self._set_desired_fact_data_type('I')
+        self._bulk_create_or_update((self.desired_fact, '12'))
+        self.assertEquals(12.0, self._get_fact('12').numeric_data)
+
+        self._bulk_create_or_update((self.desired_fact, '13'))
+        self.assertEquals(['13'], list(Fact.objects.values_list('data', flat=True)))
+        self.assertEquals(13.0, self._get_fact('13').numeric_data)
+
+        self._bulk_create_or_update((self.desired_fact, None))
+        self.assertEquals(['13'], list(Fact.objects.values_list('data', flat=True)))
+
+    def test_bulk_create_or_update_removes_duplicates(self):
+        self._save_fact('01')
+        latest = self._save_fact('02')
+        self._bulk_create_or_update((self.desired_fact, '02'))
+        self.assertEquals([latest], list(Fact.objects.all()))
+
+    def test_bulk_create_or_update_multi(self):
+        self._set_desired_fact_data_type('M')
+        other_df = DesiredFact.objects.create(code='code2', label='l',
+                data_type='T', required=True, content_type=self.content_type)
+        self._save_fact('01')
+        self._save_fact('02')
+
+        # existing facts, tombstones, delete, insert, progress counter,
+        # required facts
+        with self.assertNumQueries(6):
+            self._bulk_create_or_update((self.desired_fact, ['02', '03']),
+                    (other_df, 'text'))
+
+        self.assertEquals(set(['02', '03']), set(Fact.objects\
+                .filter(desired_fact=self.desired_fact)\
+                .values_list('data', flat=True)))
+        self.assertTrue(Fact.objects.filter(desired_fact=other_df,
+            data='text').exists())
+
+    def test_bulk_create_or_update_list_for_non_multi(self):
+        self.assertRaises(ValueError, self._bulk_create_or_update,
+                (self.desired_fact, ['01']))
+
+    def test_bulk_create_or_update_subjects(self):
+        other = Project.objects.create(name='other')
+        self._bulk_create_or_update((self.desired_fact, '01'))
+        # existing facts, update, insert, progress counter, required facts,
+        # subjects progress
+        with self.assertNumQueries(7):
+            counts = Fact.bulk_create_or_update_subjects(self.survey,
+                    self.content_type, {self.subject.id: [
+                        (self.desired_fact, '02')], other.id: [
+                        (self.desired_fact, '03')]}, self.user)
+        self.assertEquals((1, 1, 0), counts)
+        self.assertEquals(set([(self.subject.id, '02'), (other.id, '03')]),
+                set(Fact.objects.values_list('object_id', 'data')))
+        self.assertEquals(2, SurveyDesiredFact.objects\
+                .get(desired_fact=self.desired_fact).facts_collected)
+
     def test_existing_facts(self):
         self._save_fact('01')
         existing_facts = dict(Fact.existing_facts(self.survey, self.subject).items())
@@ -108,9 +223,206 @@ class SubjectTests(SurveyTestCase):
 
         self.assertTrue(has_required_data(self.survey, self.subject))
 
+    def test_missing_required_data(self):
+        desired_fact_2 = DesiredFact.objects.create(code='code2',
+                label='enter data', data_type='T',
+                required=True, content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=desired_fact_2)
+        subject2 = Project.objects.create(name='subject_standin2')
+        subject3 = Project.objects.create(name='subject_standin3')
+
+        self._save_fact('1')
+        self._save_fact('1', subject=subject2)
+        self._save_fact('1', subject=subject2, desired_fact=desired_fact_2)
+
+        subjects_qs = Project.objects.filter(
+                id__in=(self.subject.id, subject2.id, subject3.id))
+        with self.assertNumQueries(3):
+            missing = missing_required_data(self.survey, subjects_qs)
+
+        self.assertEquals([(self.subject.id, ['code2']),
+                           (subject3.id, ['code1', 'code2'])],
+                list(missing.items()))
+
+
+class ProgressTests(SurveyTestCase):
+    def setUp(self):
+        super(ProgressTests, self).setUp()
+        self.login()
+        self.desired_fact_2 = DesiredFact.objects.create(code='code2',
+                label='enter data', data_type='M',
+                required=False, content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=self.desired_fact_2)
+
+    def _create_or_update(self, desired_fact, data, subject=None):
+        subject = subject or self.subject
+        Fact.create_or_update(self.survey, desired_fact, self.content_type,
+                subject.id, data, self.user)
+
+    def _progress(self):
+        progress = SurveyProgress.objects.get(survey=self.survey,
+                content_type=self.content_type)
+        collected = dict(SurveyDesiredFact.objects.filter(survey=self.survey)\
+                .values_list('desired_fact__code', 'facts_collected'))
+        return progress.subjects_started, progress.subjects_completed, collected
+
+    def test_counters_follow_writes(self):
+        subject2 = Project.objects.create(name='subject_standin2')
+
+        self._create_or_update(self.desired_fact_2, ['01', '02'])
+        self.assertEquals((1, 0, {'code1': 0, 'code2': 2}), self._progress())
+
+        self._create_or_update(self.desired_fact, 'a')
+        self._create_or_update(self.desired_fact, 'b', subject=subject2)
+        self.assertEquals((2, 2, {'code1': 2, 'code2': 2}), self._progress())
+
+        self._create_or_update(self.desired_fact_2, ['02'])
+        self._create_or_update(self.desired_fact, 'c')
+        self.assertEquals((2, 2, {'code1': 2, 'code2': 1}), self._progress())
+
+    def test_create_or_update_only_loads_its_desired_fact(self):
+        self._create_or_update(self.desired_fact_2, ['01', '02'])
+        self._create_or_update(self.desired_fact, 'a')
+        # the fact, and the update
+        with self.assertNumQueries(2):
+            self._create_or_update(self.desired_fact, 'b')
+        self.assertEquals((1, 1, {'code1': 1, 'code2': 2}), self._progress())
+
+        self._create_or_update(self.desired_fact_2, [])
+        self.assertEquals((1, 1, {'code1': 1, 'code2': 0}), self._progress())
+
+    def test_incomplete_subject_pks_ignores_stale_counters(self):
+        self.desired_fact_2.required = True
+        self.desired_fact_2.save()
+        # facts written without updating the counters, which are stale
+        self._save_fact('a')
+        SurveyProgress.objects.create(survey=self.survey,
+                content_type=self.content_type, subjects_started=1,
+                subjects_completed=1)
+
+        self.assertEquals([self.subject.id],
+                incomplete_subject_pks(self.survey, self.content_type))
+
+    def test_rebuild_progress(self):
+        self._create_or_update(self.desired_fact_2, ['01', '02'])
+        self._save_fact('a', subject=Project.objects.create(name='s2'))
+        expected = (2, 1, {'code1': 1, 'code2': 2})
+        self.assertNotEquals(expected, self._progress())
+
+        rebuild_progress(self.survey)
+        self.assertEquals(expected, self._progress())
+
+
 class SurveyTests(SurveyTestCase):
 
     def test_survey_content_types(self):
         self.assertEquals(
                 [ContentType.objects.get_for_model(Project)],
                 self.survey.content_types())
+
+
+class ExportJobTests(SurveyTestCase):
+    def setUp(self):
+        super(ExportJobTests, self).setUp()
+        self.login()
+
+    def test_claim_next(self):
+        first = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+        second = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+
+        claimed = ExportJob.claim_next()
+        self.assertEquals(first, claimed)
+        self.assertEquals(RUNNING, claimed.status)
+        self.assertNotEquals(None, claimed.started_on)
+        self.assertEquals(second, ExportJob.claim_next())
+        self.assertEquals(None, ExportJob.claim_next())
+
+    def test_fail_stale(self):
+        stale = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+        ExportJob.claim_next()
+        ExportJob.objects.filter(pk=stale.pk)\
+                .update(heartbeat_on=timezone.now() - timedelta(hours=2))
+        running = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+        ExportJob.claim_next()
+        pending = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+
+        self.assertEquals(1, ExportJob.fail_stale(60 * 60))
+        self.assertEquals([FAILED, RUNNING, PENDING],
+                [ExportJob.objects.get(pk=job.pk).status
+                    for job in (stale, running, pending)])
+
+    def test_progress(self):
+        job = ExportJob.objects.create(survey=self.survey,
+                created_by=self.user)
+        job.start(10)
+        job.add_progress(3)
+        job.add_progress(4)
+        self.assertEquals(7, ExportJob.objects.get(pk=job.pk).rows_done)
+
+        job.finish('export.xlsx')
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEquals((10, 10), (job.rows_done, job.rows_total))
+
+
+class SurveySchemaTests(SurveyTestCase):
+    def setUp(self):
+        super(SurveySchemaTests, self).setUp()
+        self.select_fact = DesiredFact.objects.create(code='code0',
+                label='choose', data_type='S', required=False,
+                content_type=self.content_type)
+        FactOption.objects.create(code='01', description='a',
+                desired_fact=self.select_fact)
+        SurveyDesiredFact.objects.create(survey=self.survey, weight=0,
+                fact_group=self.fact_group, desired_fact=self.select_fact)
+
+    def test_schema(self):
+        schema = survey_schema(self.survey).for_content_type(self.content_type)
+        self.assertEquals(['code0', 'code1'],
+                [df.code for df in schema.desired_facts])
+        self.assertEquals({'code0': 0, 'code1': 1}, schema.index)
+        self.assertEquals(frozenset([self.desired_fact.id]),
+                schema.required_ids)
+        self.assertEquals(['group1'], [group.heading for group in schema.groups])
+        self.assertEquals((('', 'Make a selection'), ('01', '1-a')),
+                schema.by_code['code0'].choices)
+        self.assertEquals(None, schema.by_code['code1'].choices)
+        self.assertRaises(AttributeError, setattr, schema, 'index', {})
+
+    def test_cached_until_definition_changes(self):
+        schema = survey_schema(self.survey)
+        with self.assertNumQueries(0):
+            self.assertTrue(schema is survey_schema(self.survey))
+            self.assertEquals([('', 'Make a selection'), ('01', '1-a')],
+                    self.select_fact.choices)
+
+        FactOption.objects.create(code='02', description='b',
+                desired_fact=self.select_fact)
+        new_schema = survey_schema(self.survey)
+        self.assertFalse(schema is new_schema)
+        self.assertEquals(3, len(new_schema.desired_facts[
+                self.select_fact.id].choices))
+
+    def test_empty_content_type(self):
+        content_type = ContentType.objects.get_for_model(FactOption)
+        schema = survey_schema(self.survey).for_content_type(content_type)
+        self.assertEquals((), schema.desired_facts)
+        self.assertEquals(frozenset(), schema.required_ids)
+
+    def test_version_changes_again_after_request(self):
+        version = schema_version()
+        FactOption.objects.create(code='03', description='c',
+                desired_fact=self.select_fact)
+        changed = schema_version()
+        self.assertNotEquals(version, changed)
+
+        # tests run in a managed transaction, so the change may not have
+        # been committed yet
+        request_finished.send(sender=self.__class__)
+        self.assertNotEquals(changed, schema_version())
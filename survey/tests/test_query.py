@@ -1,7 +1,10 @@
 from survey.tests.utils import SurveyTestCase
 
-from survey.query import get_subjects, sum_facts_where, sum_facts
-from survey.models import Project, Survey, DesiredFact
+from survey.query import (get_subjects, sum_facts_where, sum_facts,
+        avg_facts, min_facts, max_facts, count_facts, avg_facts_where,
+        get_number_of_subjects_where, frequency_table, crosstab, FactQ,
+        filter_subjects)
+from survey.models import Project, Survey, DesiredFact, FactOption, Fact
 
 class QueryTests(SurveyTestCase):
     def setUp(self):
@@ -49,6 +52,20 @@ class QueryTests(SurveyTestCase):
                 list(subjects)
             )
 
+    def test_get_subjects_range(self):
+        self._save_fact('5', subject=self.subject)
+        self._save_fact('5000', subject=self.subject2)
+
+        def subjects(**kwargs):
+            return set(get_subjects(self.survey, self.content_type,
+                desired_facts=self.desired_fact, **kwargs))
+
+        self.assertEquals(set([self.subject2]), subjects(gt=5))
+        self.assertEquals(set([self.subject]), subjects(lt=5000))
+        self.assertEquals(set([self.subject, self.subject2]),
+                subjects(between=(5, 5000)))
+        self.assertEquals(set(), subjects(gt=5, lt=5000))
+
     def test_facts_for_different_survey_not_counted(self):
         "must discriminate by survey"
         # associate self.subject with self.survey
@@ -138,3 +155,175 @@ class QueryTests(SurveyTestCase):
 
         self.assertEquals(2, sum_facts(self.survey,
             subjects_qs, self.desired_fact))
+
+    def test_sum_facts_blank_counts_as_zero(self):
+        self._save_fact('', subject=self.subject)
+        self._save_fact('04', subject=self.subject2)
+
+        subjects_qs = Project.objects\
+                .filter(id__in=(self.subject.id, self.subject2.id))
+
+        self.assertEquals(4, sum_facts(self.survey,
+            subjects_qs, self.desired_fact))
+
+    def test_sum_facts_float(self):
+        self.desired_fact.data_type = 'F'
+        self.desired_fact.save()
+        self._save_fact('1.5', subject=self.subject)
+        self._save_fact('2.25', subject=self.subject2)
+
+        subjects_qs = Project.objects\
+                .filter(id__in=(self.subject.id, self.subject2.id))
+
+        self.assertAlmostEqual(3.75, sum_facts(self.survey,
+            subjects_qs, self.desired_fact))
+
+    def test_sum_facts_yes_no(self):
+        self.desired_fact.data_type = 'Y'
+        self.desired_fact.save()
+        self._save_fact('1', subject=self.subject)
+        self._save_fact('2', subject=self.subject2)
+
+        subjects_qs = Project.objects\
+                .filter(id__in=(self.subject.id, self.subject2.id))
+
+        self.assertEquals(1, sum_facts(self.survey,
+            subjects_qs, self.desired_fact))
+
+    def test_other_aggregates(self):
+        self._save_fact('02', subject=self.subject)
+        self._save_fact('06', subject=self.subject2)
+
+        subjects_qs = Project.objects\
+                .filter(id__in=(self.subject.id, self.subject2.id))
+
+        self.assertEquals(4, avg_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(2, min_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(6, max_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(2, count_facts(self.survey, subjects_qs,
+            self.desired_fact))
+
+    def test_other_aggregates_no_match(self):
+        subjects_qs = Project.objects.none()
+        self.assertEquals(None, avg_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(None, max_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(0, count_facts(self.survey, subjects_qs,
+            self.desired_fact))
+        self.assertEquals(None, avg_facts_where(self.survey, subjects_qs,
+            self.desired_fact, match_df=self.desired_fact))
+
+    def test_get_number_of_subjects_where(self):
+        self._save_fact('01', subject=self.subject)
+        self._save_fact('01', subject=self.subject)
+        self._save_fact('01', subject=self.subject2)
+        self._save_fact('02', subject=self.subject2)
+
+        subjects_qs = Project.objects\
+                .filter(id__in=(self.subject.id, self.subject2.id))
+        self.assertEquals(2, get_number_of_subjects_where(self.survey,
+            subjects_qs, self.desired_fact, '01'))
+
+    def test_sum_facts_where_single_query(self):
+        self._save_fact('01', subject=self.subject)
+        self._save_fact('02', subject=self.subject2)
+
+        subjects_qs = Project.objects.filter(name__startswith='subject_standin')
+        with self.assertNumQueries(1):
+            total = sum_facts_where(self.survey, subjects_qs,
+                    match_df=self.desired_fact, match_value='02',
+                    sum_dfs=self.desired_fact)
+        self.assertEquals(2, total)
+
+
+class FrequencyTableTests(SurveyTestCase):
+    def setUp(self):
+        super(FrequencyTableTests, self).setUp()
+        self.login()
+
+        self.desired_fact.data_type = 'S'
+        self.desired_fact.save()
+        FactOption.objects.create(desired_fact=self.desired_fact,
+                code='01', description='red')
+        FactOption.objects.create(desired_fact=self.desired_fact,
+                code='02', description='blue')
+        self.yes_no_df = DesiredFact.objects.create(code='code2',
+                label='a', data_type='Y', required=True,
+                content_type=self.content_type)
+        self.weight_df = DesiredFact.objects.create(code='code3',
+                label='a', data_type='F', required=True,
+                content_type=self.content_type)
+
+        self.subjects = [Project.objects.create(name='subject%s' % i)
+                for i in range(3)]
+        for subject, colour, yes_no, weight in zip(self.subjects,
+                ['01', '01', '02'], ['1', '2', '1'], ['1.5', '2', '4']):
+            for desired_fact, data in [(self.desired_fact, colour),
+                    (self.yes_no_df, yes_no), (self.weight_df, weight)]:
+                Fact.create_or_update(self.survey, desired_fact,
+                        self.content_type, subject.id, data, self.user)
+        self.subjects_qs = Project.objects.filter(name__startswith='subject')
+
+    def test_frequency_table(self):
+        with self.assertNumQueries(2):
+            table = frequency_table(self.survey, self.subjects_qs,
+                    self.desired_fact)
+        self.assertEquals([('01', 'red', 2), ('02', 'blue', 1)], table)
+
+    def test_weighted_frequency_table(self):
+        table = frequency_table(self.survey, self.subjects_qs,
+                self.desired_fact, weight_df=self.weight_df)
+        self.assertEquals([('01', 'red', 3.5), ('02', 'blue', 4)], table)
+
+    def test_crosstab(self):
+        rows, columns, cells = crosstab(self.survey, self.subjects_qs,
+                self.desired_fact, self.yes_no_df)
+        self.assertEquals([('01', 'red'), ('02', 'blue')], rows)
+        self.assertEquals([('1', 'Yes'), ('2', 'No')], columns)
+        self.assertEquals({('01', '1'): 1, ('01', '2'): 1,
+                           ('02', '1'): 1, ('02', '2'): 0}, cells)
+
+
+class FactQTests(SurveyTestCase):
+    def setUp(self):
+        super(FactQTests, self).setUp()
+        self.login()
+        for code, data_type in [('tv', 'Y'), ('income', 'I'), ('region', 'S')]:
+            setattr(self, code, DesiredFact.objects.create(code=code,
+                label=code, data_type=data_type, required=True,
+                content_type=self.content_type))
+
+        self.subjects = []
+        for tv, income, region in [('1', '6000', '3'), ('1', '7000', '5'),
+                ('2', '8000', '4'), ('1', '100', '4'), ('1', '9000', '4')]:
+            subject = Project.objects.create(name='subject')
+            for desired_fact, data in [(self.tv, tv), (self.income, income),
+                    (self.region, region)]:
+                Fact.create_or_update(self.survey, desired_fact,
+                        self.content_type, subject.id, data, self.user)
+            self.subjects.append(subject)
+        self.subjects_qs = Project.objects.filter(name='subject')
+
+    def test_filter_subjects(self):
+        condition = FactQ('tv', value='1') & FactQ('income', gt=5000) &\
+                (FactQ('region', value='3') | FactQ('region', value='4'))
+        with self.assertNumQueries(1):
+            subjects = list(filter_subjects(self.survey, self.subjects_qs,
+                condition))
+        self.assertEquals(set([self.subjects[0], self.subjects[4]]),
+                set(subjects))
+
+    def test_negation(self):
+        condition = ~FactQ('region', value='4')
+        self.assertEquals(set(self.subjects[:2]), set(filter_subjects(
+            self.survey, self.subjects_qs, condition)))
+
+    def test_feeds_aggregates(self):
+        subjects_qs = filter_subjects(self.survey, self.subjects_qs,
+                FactQ('region', value='4') & FactQ('tv', value='1'))
+        self.assertEquals(9100, sum_facts(self.survey, subjects_qs,
+            self.income))
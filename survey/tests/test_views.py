@@ -1,9 +1,15 @@
+import json
+
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.test.client import RequestFactory
 
-from survey.models import DesiredFact, SurveyDesiredFact
+from survey.models import (DesiredFact, SurveyDesiredFact, Fact, ExportJob,
+        Project, XLSX, CSV)
 from survey.tests.utils import SurveyTestCase
-from survey.views import _update_fact
+from survey.views import _update_fact, IncompleteSubjectsView, export_csv
 from survey.forms import MultipleChoiceFactField
 
 class UpdateFactTests(SurveyTestCase):
@@ -31,3 +37,190 @@ class UpdateFactTests(SurveyTestCase):
         self.assertTrue(isinstance(form.fields[desired_fact_2.code], 
             MultipleChoiceFactField))
 
+
+    def test_unknown_code(self):
+        self.login()
+        self.assertEquals(None, _update_fact(self.survey, self.subject,
+                'unknown', self.content_type, data={'unknown': 'a'},
+                user=self.user))
+
+        response = self.client.post(reverse('survey-ajax-fact',
+                kwargs={'survey_id': self.survey.id}), {
+            'contentTypeId': self.content_type.id,
+            'objectId': self.subject.id,
+            'code': 'unknown', 'data': 'a'})
+        self.assertEquals({'success': False}, json.loads(response.content))
+        self.assertEquals(0, Fact.objects.count())
+
+
+class AjaxFactsTests(SurveyTestCase):
+    def setUp(self):
+        super(AjaxFactsTests, self).setUp()
+        self.login()
+        self.desired_fact_2 = DesiredFact.objects.create(code='code2',
+                label='enter data', data_type='I',
+                required=True, content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=self.desired_fact_2)
+
+    def _post(self, updates):
+        url = reverse('survey-ajax-facts', kwargs={'survey_id': self.survey.id})
+        response = self.client.post(url, {
+            'contentTypeId': self.content_type.id,
+            'objectId': self.subject.id,
+            'facts': json.dumps(updates),
+        })
+        return json.loads(response.content)
+
+    def test_batch_update(self):
+        result = self._post([{'code': 'code1', 'data': 'a'},
+                             {'code': 'code2', 'data': '3'}])
+
+        self.assertEquals({'success': True,
+            'results': {'code1': True, 'code2': True}}, result)
+        self.assertEquals('a', self._get_fact('a').data)
+        self.assertTrue(Fact.objects.filter(desired_fact=self.desired_fact_2,
+            data='3').exists())
+
+    def test_batch_update_per_field_failure(self):
+        result = self._post([{'code': 'code1', 'data': 'a'},
+                             {'code': 'code2', 'data': 'not a number'},
+                             {'code': 'unknown', 'data': '1'}])
+
+        self.assertEquals({'success': False, 'results': {
+            'code1': True, 'code2': False, 'unknown': False}}, result)
+        self.assertTrue(Fact.objects.filter(data='a').exists())
+        self.assertFalse(Fact.objects.filter(
+            desired_fact=self.desired_fact_2).exists())
+
+    def test_batch_update_bad_request(self):
+        self.assertEquals({'success': False, 'results': {}},
+                self._post('not a list'))
+
+    def test_batch_update_malformed_updates(self):
+        result = self._post([1, None, {'data': 'a'}, {'code': 2},
+                             {'code': 'code1', 'data': 'a'}])
+        self.assertFalse(result['success'])
+        self.assertEquals({'1': False, 'null': False, '{"data": "a"}': False,
+                '{"code": 2}': False, 'code1': True}, result['results'])
+        self.assertTrue(Fact.objects.filter(data='a').exists())
+
+
+class ExportCsvTests(SurveyTestCase):
+    def setUp(self):
+        super(ExportCsvTests, self).setUp()
+        self.login()
+        self._save_fact('a, b')
+
+    def _get(self, format):
+        url = reverse('survey-export-csv', kwargs={'survey_id': self.survey.id,
+            'app': self.content_type.app_label,
+            'model': self.content_type.model, 'format': format})
+        return self.client.get(url)
+
+    def test_export_csv(self):
+        response = self._get('csv')
+        self.assertTrue(response.streaming)
+        self.assertEquals('text/csv', response['Content-Type'])
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEquals('code1', lines[0])
+        self.assertTrue('"a, b"' in lines)
+
+    def test_export_tsv(self):
+        response = self._get('tsv')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertTrue('a, b' in lines)
+
+    def test_export_csv_unknown_content_type(self):
+        # called directly, as the client would render the host's 404.html
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertRaises(Http404, export_csv, request,
+                survey_id=str(self.survey.id), app='nosuch', model='model',
+                format='csv')
+
+
+class ExportJobViewTests(SurveyTestCase):
+    def setUp(self):
+        super(ExportJobViewTests, self).setUp()
+        self.login()
+
+    def _start(self, **data):
+        url = reverse('survey-export-start',
+                kwargs={'survey_id': self.survey.id})
+        return json.loads(self.client.post(url, data).content)
+
+    def _status(self, job):
+        url = reverse('survey-export-status',
+                kwargs={'survey_id': self.survey.id, 'job_id': job.id})
+        return json.loads(self.client.get(url).content)
+
+    def test_start_export(self):
+        result = self._start()
+        self.assertTrue(result['success'])
+        job = ExportJob.objects.get(pk=result['jobId'])
+        self.assertEquals((XLSX, None), (job.format, job.content_type))
+
+        result = self._start(format='csv', app=self.content_type.app_label,
+                model=self.content_type.model)
+        job = ExportJob.objects.get(pk=result['jobId'])
+        self.assertEquals((CSV, self.content_type),
+                (job.format, job.content_type))
+
+    def test_start_export_bad_request(self):
+        self.assertFalse(self._start(format='pdf')['success'])
+        self.assertFalse(self._start(format='csv', app='no', model='no')['success'])
+
+    def test_status(self):
+        job = ExportJob.objects.get(pk=self._start()['jobId'])
+        status = self._status(job)
+        self.assertEquals('Pending', status['status'])
+        self.assertEquals(None, status['downloadUrl'])
+
+        download_url = reverse('survey-export-download',
+                kwargs={'survey_id': self.survey.id, 'job_id': job.id})
+        self.assertEquals(404, self.client.get(download_url).status_code)
+
+        job.start(3)
+        job.finish('export.xlsx')
+        status = self._status(job)
+        self.assertEquals(('Done', 3, 3), (status['status'],
+                status['rowsDone'], status['rowsTotal']))
+        self.assertEquals(download_url, status['downloadUrl'])
+
+
+class IncompleteSubjectsViewTests(SurveyTestCase):
+    def setUp(self):
+        super(IncompleteSubjectsViewTests, self).setUp()
+        self.login()
+        self.desired_fact_2 = DesiredFact.objects.create(code='code2',
+                label='enter data', data_type='T', required=True,
+                content_type=self.content_type)
+        SurveyDesiredFact.objects.create(survey=self.survey,
+                fact_group=self.fact_group, desired_fact=self.desired_fact_2)
+
+    def _get(self, app=None, model=None):
+        # call the view directly, so that the response isn't rendered with
+        # a template that extends the host project's
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return IncompleteSubjectsView.as_view()(request,
+                survey_id=str(self.survey.id),
+                app=app or self.content_type.app_label,
+                model=model or self.content_type.model)
+
+    def test_lists_incomplete_subjects_of_the_survey(self):
+        complete = Project.objects.create(name='complete')
+        for desired_fact in (self.desired_fact, self.desired_fact_2):
+            Fact.create_or_update(self.survey, desired_fact, self.content_type,
+                    complete.id, 'a', self.user)
+        Fact.create_or_update(self.survey, self.desired_fact,
+                self.content_type, self.subject.id, 'a', self.user)
+
+        response = self._get()
+        # self.project has no facts, so isn't a subject of the survey
+        self.assertEquals([(self.subject, ['code2'])],
+                response.context_data['incomplete_subjects'])
+
+    def test_unknown_content_type(self):
+        self.assertRaises(Http404, self._get, app='nosuch', model='model')
@@ -9,6 +9,26 @@ urlpatterns = patterns('',
     url(r'^survey/(?P<pk>\d+)/$', views.SurveyDetailView.as_view(),
         name='survey-detail'),
 
+    url(r'^survey/(?P<survey_id>\d+)/(?P<app>\w+)/(?P<model>\w+)/incomplete/$',
+        views.IncompleteSubjectsView.as_view(),
+        name='survey-incomplete-subjects'),
+
+    url(r'^survey/(?P<survey_id>\d+)/(?P<app>\w+)/(?P<model>\w+)/export\.(?P<format>csv|tsv)$',
+        views.export_csv,
+        name='survey-export-csv'),
+
+    url(r'^survey/(?P<survey_id>\d+)/exports/$',
+        views.start_export,
+        name='survey-export-start'),
+
+    url(r'^survey/(?P<survey_id>\d+)/exports/(?P<job_id>\d+)/$',
+        views.export_status,
+        name='survey-export-status'),
+
+    url(r'^survey/(?P<survey_id>\d+)/exports/(?P<job_id>\d+)/download/$',
+        views.download_export,
+        name='survey-export-download'),
+
     url(r'^survey/(?P<survey_id>\d+)/desiredfacts/$',
         views.DesiredFactListView.as_view(),
         name='survey-desired-facts'),
@@ -17,6 +37,10 @@ urlpatterns = patterns('',
         views.ajax_fact,
         name='survey-ajax-fact'),
 
+    url(r'^survey/(?P<survey_id>\d+)/ajaxfacts/$',
+        views.ajax_facts,
+        name='survey-ajax-facts'),
+
     url(r'^survey/(?P<survey_id>\d+)/(?P<app>\w+)/(?P<model>\w+)/(?P<pk>\w+)/detail/$',
         views.SurveySubjectDetailView.as_view(), name='subject-detail'),
 
@@ -1,15 +1,33 @@
 import json
+import os
+from collections import OrderedDict
+
 from django.shortcuts import get_object_or_404
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import (HttpResponseRedirect, HttpResponse,
+        StreamingHttpResponse, Http404)
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
+from django.core.servers.basehttp import FileWrapper
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
+from django.utils.datastructures import MultiValueDict
+
+from survey import models, forms, export
+
+
+def _content_type_or_404(app_label, model):
+    try:
+        content_type = ContentType.objects.get_by_natural_key(app_label, model)
+    except ContentType.DoesNotExist:
+        raise Http404
+    if content_type.model_class() is None:
+        raise Http404
+    return content_type
 
-from survey import models, forms
 
 class ProjectsListView(ListView):
     model = models.Project
@@ -32,6 +50,50 @@ class SurveyDetailView(DetailView):
     def dispatch(self, request, *args, **kwargs):
         return super(SurveyDetailView, self).dispatch(request, *args, **kwargs)
 
+    def get_context_data(self, **kwargs):
+        context = super(SurveyDetailView, self).get_context_data(**kwargs)
+        # progress comes from counters, so this is two queries however
+        # much data has been gathered
+        context['progress'] = self.object.surveyprogress_set\
+                .select_related('content_type')
+        context['desired_fact_progress'] = self.object.surveydesiredfact_set\
+                .select_related('desired_fact')\
+                .order_by('fact_group__weight', 'weight')
+        return context
+
+
+class IncompleteSubjectsView(ListView):
+    """Lists the subjects of one content type that are missing required
+    data in a survey, with the codes of the missing desired facts.
+    """
+    context_object_name = 'incomplete_subjects'
+    template_name = 'survey/incomplete_subjects.html'
+    paginate_by = 100
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        self.survey = get_object_or_404(models.Survey, pk=kwargs['survey_id'])
+        self.content_type = _content_type_or_404(kwargs['app'], kwargs['model'])
+        return super(IncompleteSubjectsView, self).dispatch(request, *args, **kwargs)
+
+    def get_queryset(self):
+        # subjects are those with facts in the survey
+        return models.incomplete_subject_pks(self.survey, self.content_type)
+
+    def get_context_data(self, **kwargs):
+        context = super(IncompleteSubjectsView, self).get_context_data(**kwargs)
+        # only fetch the subjects, and their missing codes, on this page
+        page = list(context['incomplete_subjects'])
+        subjects_qs = self.content_type.model_class().objects
+        subjects = subjects_qs.in_bulk(page)
+        missing = models.missing_required_data(self.survey,
+                subjects_qs.filter(pk__in=page))
+        context['incomplete_subjects'] = [(subjects[pk], missing.get(pk, []))
+                for pk in page if pk in subjects]
+        context['content_type'] = self.content_type
+        context['survey'] = self.survey
+        return context
+
 
 class DesiredFactListView(ListView):
     model = models.DesiredFact
@@ -141,36 +203,188 @@ class EditSurveySubjectView(FormView):
                 "survey/edit_survey_subject.html"]
 
 def _update_fact(survey, subject, code, content_type, data, user):
-    # create a miniature form for this desired fact only, and save the fact
-    sdf = models.SurveyDesiredFact.objects\
-            .get(survey=survey, desired_fact__code=code,
-                    desired_fact__content_type=content_type)
-    form_class = forms._survey_form_subclass(forms.BaseSurveyForm, [sdf])
+    """Validate and save this desired fact's field only. Return the form,
+    or None if the survey has no desired fact with the code for the
+    content type.
+    """
+    form_class = forms.make_survey_form_subclass(survey, content_type)
     form = form_class(subject=subject, survey=survey, user=user, data=data)
+    if code not in form.fields:
+        return None
+    form.fields = OrderedDict([(code, form.fields[code])])
     form.save_valid()
     return form
 
+EXPORT_FORMATS = {
+    'csv': (',', 'text/csv'),
+    'tsv': ('\t', 'text/tab-separated-values'),
+}
+
 @login_required
-def ajax_fact(request, survey_id):
-    def json_response(success):
-        return HttpResponse(json.dumps({'success': bool(success)}),
-                            content_type="application/json")
+def export_csv(request, survey_id, app, model, format):
+    """Stream all the survey's data for one content type as CSV or TSV."""
+    survey = get_object_or_404(models.Survey, pk=survey_id)
+    content_type = _content_type_or_404(app, model)
+    delimiter, mimetype = EXPORT_FORMATS[format]
+
+    csv_export = export.CsvExport(survey, content_type, delimiter=delimiter)
+    response = StreamingHttpResponse(csv_export.iter_lines(),
+            content_type=mimetype)
+    response['Content-Disposition'] = 'attachment; filename="%s_%s.%s"' %\
+            (survey.pk, model, format)
+    return response
+
+XLSX_MIMETYPE = \
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+@require_POST
+@login_required
+def start_export(request, survey_id):
+    """Queue an export job for the run_export_worker command. Expects a
+    format of xlsx (the default), csv or tsv, with the app and model of
+    the content type to export for the latter two. With delta=1, only
+    subjects changed since the survey's last recorded export covering the
+    same content types are included.
+    """
+    survey = get_object_or_404(models.Survey, pk=survey_id)
+    format = request.POST.get('format', models.XLSX)
+    content_type = None
+    if format in EXPORT_FORMATS:
+        try:
+            content_type = ContentType.objects.get_by_natural_key(
+                    request.POST.get('app'), request.POST.get('model'))
+        except ContentType.DoesNotExist:
+            return _json_response({'success': False})
+    elif format != models.XLSX:
+        return _json_response({'success': False})
+
+    since = None
+    if request.POST.get('delta') == '1':
+        since = export.last_export_watermark(survey, content_type)
+    job = models.ExportJob.objects.create(survey=survey, format=format,
+            content_type=content_type, since=since, created_by=request.user)
+    return _json_response({'success': True, 'jobId': job.pk,
+            'statusUrl': reverse('survey-export-status',
+                kwargs={'survey_id': survey.pk, 'job_id': job.pk})})
 
+@login_required
+def export_status(request, survey_id, job_id):
+    """Report an export job's status and progress, with the URL to download
+    the file from once it's done.
+    """
+    job = get_object_or_404(models.ExportJob, pk=job_id, survey=survey_id)
+    status = {'status': job.get_status_display(), 'rowsDone': job.rows_done,
+            'rowsTotal': job.rows_total, 'downloadUrl': None}
+    if job.status == models.DONE:
+        status['downloadUrl'] = reverse('survey-export-download',
+                kwargs={'survey_id': survey_id, 'job_id': job.pk})
+    elif job.status == models.FAILED:
+        status['error'] = job.error
+    return _json_response(status)
+
+@login_required
+def download_export(request, survey_id, job_id):
+    """Stream a finished export job's file from SPREADSHEETS_ROOT."""
+    job = get_object_or_404(models.ExportJob, pk=job_id, survey=survey_id,
+            status=models.DONE)
+    path = os.path.join(export.SPREADSHEETS_ROOT, job.filename)
+    try:
+        output = open(path, 'rb')
+    except IOError:
+        raise Http404
+    if job.format == models.XLSX:
+        mimetype = XLSX_MIMETYPE
+    else:
+        mimetype = EXPORT_FORMATS[job.format][1]
+    response = StreamingHttpResponse(FileWrapper(output),
+            content_type=mimetype)
+    response['Content-Disposition'] = 'attachment; filename="%s"' %\
+            job.filename
+    return response
+
+def _json_response(data):
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+def _ajax_subject(request, survey_id):
+    """Get the survey, content type and subject identified by an ajax
+    request, or None if they can't be found.
+    """
     try:
         content_type_id = int(request.POST.get('contentTypeId'))
         object_id = int(request.POST.get('objectId'))
-    except ValueError:
-        return json_response(False)
+    except (TypeError, ValueError):
+        return None
 
     try:
         survey = models.Survey.objects.get(pk=survey_id)
-        content_type = ContentType.objects.get(pk=content_type_id)
+        content_type = ContentType.objects.get_for_id(content_type_id)
     except (models.Survey.DoesNotExist, ContentType.DoesNotExist):
-        return json_response(False)
+        return None
 
     subject = content_type.get_object_for_this_type(pk=object_id)
+    return survey, content_type, subject
+
+@login_required
+def ajax_fact(request, survey_id):
+    def json_response(success):
+        return _json_response({'success': bool(success)})
+
+    survey_subject = _ajax_subject(request, survey_id)
+    if survey_subject is None:
+        return json_response(False)
+
+    survey, content_type, subject = survey_subject
     code = request.POST.get('code')
     data = {code: request.POST.get('data')}
     form = _update_fact(survey, subject, code, content_type, data, request.user)
-    return json_response(form.is_valid)
+    return json_response(form is not None and form.is_valid())
 
+def _update_facts(survey, subject, content_type, updates, user):
+    """Validate and save many {'code': ..., 'data': ...} updates for one
+    subject, using the cached form class for the subject's content type.
+    Return {code: success, ...}, where updates that aren't objects with a
+    string code fail.
+    """
+    data = MultiValueDict()
+    # malformed updates fail, keyed by their JSON as they have no code
+    malformed = {}
+    for update in updates:
+        if not isinstance(update, dict) or \
+                not isinstance(update.get('code'), basestring):
+            malformed[json.dumps(update)] = False
+            continue
+        values = update.get('data')
+        if not isinstance(values, list):
+            values = [values]
+        data.setlist(update['code'], values)
+
+    form_class = forms.make_survey_form_subclass(survey, content_type)
+    form = form_class(subject=subject, survey=survey, user=user, data=data)
+    # only validate and save the fields being updated
+    form.fields = OrderedDict((code, field)
+            for code, field in form.fields.items() if code in data)
+    form.save_valid()
+    results = dict((code, code in form.fields and code not in form.errors)
+            for code in data)
+    results.update(malformed)
+    return results
+
+@login_required
+def ajax_facts(request, survey_id):
+    """Save a batch of fact updates for one subject. Expects the subject's
+    contentTypeId and objectId, and a JSON list of {code, data} objects in
+    facts.
+    """
+    survey_subject = _ajax_subject(request, survey_id)
+    try:
+        updates = json.loads(request.POST.get('facts', ''))
+    except ValueError:
+        updates = None
+    if survey_subject is None or not isinstance(updates, list):
+        return _json_response({'success': False, 'results': {}})
+
+    survey, content_type, subject = survey_subject
+    results = _update_facts(survey, subject, content_type, updates,
+            request.user)
+    return _json_response({'success': all(results.values()),
+                           'results': results})